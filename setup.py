@@ -21,7 +21,7 @@ setuptools.setup(
     author_email='twestbrook@synthetic-dreams.com',
     packages=["images"],
     package_data={'': ['*']},
-    scripts=['zisax.py'],
+    scripts=['zisax.py', 'zisax_trace.py', 'zisax_fleet.py', 'zisax_bench.py', 'zisax_image.py'],
     include_package_data=True,
     url='http://github.com/ToniWestbrook/zisa-x',
     license='LICENSE',
@@ -1,28 +1,80 @@
 #! /usr/bin/env python3
 
 import argparse
+import bisect
+import collections
 import curses
+import hashlib
+import json
 import math
+import mmap
 import os
 import random
+import re
+import select
 import signal
+import struct
 import sys
-import queue
+import threading
+import time
 import z80
+import zlib
+
+# Logging state, hot paths check debug_log before building log arguments
+LOG_BUFFER = 1024 * 1024
+TRACE_PATH = "trace.bin"
+STATE_MAGIC = b"ZXS2"
+STATE_HEADER = struct.Struct("<4sII")
+
+# CP/M memory map in the TPA bank, used for stack and profile reports
+SECTIONS = { "PROG/MODULE": (0x0100, 0x8000), "STARTUP": (0x8000, 0xC000), "CCP": (0xC000, 0xC8F9), "BDOS": (0xC8F9, 0xDA00), "INT": (0xDA00, 0xF000) }
+
+log_handles = {}
+debug_log = False
+machine = None
+
+def map_copy(handle, size):
+    # Private copy-on-write mapping, short files are copied into anonymous memory instead
+    if os.fstat(handle.fileno()).st_size >= size:
+        return mmap.mmap(handle.fileno(), size, access=mmap.ACCESS_COPY)
+
+    mapping = mmap.mmap(-1, size)
+    data = handle.read(size)
+    mapping[:len(data)] = data
+    return mapping
 
 class MMU:
     PORT_BASE = 0x0000
+    PORTS = range(PORT_BASE, PORT_BASE + 4)
+    PAGE_COUNT = 256
+    CHIP_SIZE = 1024 * 1024
+    NVRAM_SYNC_DELAY = 1.0
 
-    def __init__(self, cpu):
+    def __init__(self, cpu, flat=False, debug=False):
         self.cpu = cpu
+        self.flat = flat
+        self.debug = debug
+        self.window = None
+        self.segments = []
+
         self.cpu.set_read_callback(self.read)
-        self.cpu.set_write_callback(self.write)
-        self.cpu.memory = None
 
-        self.rom = memoryview(bytearray(b"\x00" * 1024 * 1024))
-        self.ram = memoryview(bytearray(b"\x00" * 1024 * 1024))
-        self.isa = memoryview(bytearray(b"\x00" * 1024 * 1024))
-        self.nvram = memoryview(bytearray(b"\x00" * 1024 * 1024))
+        # Flat mode runs the CPU from its own 64K memory, only writes outside of RAM are called back
+        if self.flat:
+            self.window = self.cpu.memory
+            self.cpu.set_write_callback(self.write_flat)
+        else:
+            self.cpu.set_write_callback(self.write)
+            self.cpu.memory = None
+
+            # Newer Z80 cores only call back for marked addresses
+            if hasattr(self.cpu, "READ_MARK"):
+                self._set_marks(0x0000, 0x10000, self.cpu.READ_MARK | self.cpu.WRITE_MARK, True)
+
+        self.rom = memoryview(bytearray(b"\x00" * MMU.CHIP_SIZE))
+        self.ram = memoryview(bytearray(b"\x00" * MMU.CHIP_SIZE))
+        self.isa = memoryview(bytearray(b"\x00" * MMU.CHIP_SIZE))
+        self.nvram = memoryview(bytearray(b"\x00" * MMU.CHIP_SIZE))
 
         self.r_mapped = 0x00
         self.r_mode = 0x00
@@ -30,7 +82,14 @@ class MMU:
         self.r_isa_bank = 0x00
 
         self.nvram_path = None
-        self.stack_used = set()
+        self.nvram_handle = None
+        self.nvram_map = None
+        self.nvram_dirty = set()
+        self.nvram_sync_time = 0
+        self.video_dirty = set()
+        self.stack_maps = {}
+        self.stack_map = None
+        self.update_pages()
 
         # Mapped
         # 0x01: CS=ram, ram_start=0x00000, z80_start=0x0000, len=256
@@ -89,7 +148,68 @@ class MMU:
             adj_bank = self.r_pri_bank + (1 if (addr & 0x8000) else 0)
             full_addr = (adj_bank << 15) | (addr & 0x7FFF)
 
-        return chip[full_addr : full_addr + 1], chip
+        return chip, full_addr
+
+    def _set_marks(self, start, length, marks, enable):
+        # Mark in 32K chunks to stay within the core's 16-bit sizes
+        for chunk in range(start, start + length, 0x8000):
+            size = min(0x8000, start + length - chunk)
+
+            if enable:
+                self.cpu.mark_addrs(chunk, size, marks)
+            else:
+                self.cpu.unmark_addrs(chunk, size, marks)
+
+    def update_pages(self, sync=True):
+        if self.flat and sync:
+            self.sync_window()
+
+        # Translate each 256 byte page of the Z80 address space once per register change
+        self.read_pages = []
+        self.write_pages = []
+        self.page_names = []
+        self.segments = []
+        names = { id(self.rom): "rom", id(self.ram): "ram", id(self.isa): "isa", id(self.nvram): "nvram" }
+
+        for page in range(MMU.PAGE_COUNT):
+            chip, base = self._get_memory(page << 8)
+            self.read_pages.append((chip, base))
+            self.write_pages.append((chip, base, chip is not self.rom))
+            self.page_names.append(names[id(chip)])
+
+            # Merge contiguous pages into segments for bulk window copies, format [ z80_start, chip, base, length ]
+            last = self.segments[-1] if self.segments else None
+            if last and (last[1] is chip) and (last[2] + last[3] == base):
+                last[3] += 0x100
+            else:
+                self.segments.append([ page << 8, chip, base, 0x100 ])
+
+        # One 64K map of stack pointers seen per mode and bank
+        bank = (self.r_mode, self.r_pri_bank)
+        if self.debug and (bank not in self.stack_maps):
+            self.stack_maps[bank] = bytearray(0x10000)
+
+        self.stack_map = self.stack_maps.get(bank)
+
+        if self.flat:
+            self.load_window()
+
+    def sync_window(self):
+        # Copy RAM modified natively by the CPU back to the chip
+        for start, chip, base, length in self.segments:
+            if chip is self.ram:
+                chip[base:base + length] = self.window[start:start + length]
+
+    def load_window(self):
+        # Materialize the current mapping into the CPU's memory
+        self._set_marks(0x0000, 0x10000, self.cpu.WRITE_MARK, False)
+
+        for start, chip, base, length in self.segments:
+            self.window[start:start + length] = chip[base:base + length]
+
+            # ROM, NVRAM and ISA writes still need to be seen by the MMU
+            if chip is not self.ram:
+                self._set_marks(start, length, self.cpu.WRITE_MARK, True)
 
     def input(self, port):
         if port == MMU.PORT_BASE + 0:
@@ -108,61 +228,102 @@ class MMU:
 
     def output(self, port, data):
         if port == MMU.PORT_BASE + 0:
-            self.r_mapped = data
+            if self.r_mapped != data:
+                self.r_mapped = data
+                self.update_pages()
             return True
 
         if port == MMU.PORT_BASE + 1:
-            self.r_mode = data
+            if self.r_mode != data:
+                self.r_mode = data
+                self.update_pages()
             return True
 
         if port == MMU.PORT_BASE + 2:
-            self.r_pri_bank = data
+            if self.r_pri_bank != data:
+                self.r_pri_bank = data
+                self.update_pages()
             return True
 
         if port == MMU.PORT_BASE + 3:
-            self.r_isa_bank = data
+            if self.r_isa_bank != data:
+                self.r_isa_bank = data
+                self.update_pages()
             return True
 
         return False
 
     def read(self, addr):
-        # Record stack usage
-        if args.debug:
-            self.stack_used.add(self.cpu.sp)
-
         # Record registers
         #if (self.cpu.iy & 0xFF00 > 0) and (self._get_memory(addr)[0] == 0xfd):
         #    log(get_regs())
 
-        val = self._get_memory(addr)[0][0]
-        return val
+        chip, base = self.read_pages[addr >> 8]
+        return chip[base | (addr & 0xFF)]
 
     def write(self, addr, data):
-        memory, chip = self._get_memory(addr)
+        # Record stack usage, every push, call and interrupt writes just below the new SP
+        if self.debug:
+            self.stack_map[self.cpu.sp] = 1
+
+        chip, base, writable = self.write_pages[addr >> 8]
 
-        if chip is not self.rom:
-            self._get_memory(addr)[0][0] = data
+        if writable:
+            chip[base | (addr & 0xFF)] = data
         else:
-            log(f"ERROR: Writing to ROM: {hex(addr)}")
-            sys.exit(0)
+            log("ERROR: Writing to ROM: %#x", addr)
+            sys.exit(1)
 
+        # Track dirty NVRAM pages for write-back
         if chip is self.nvram:
-            self.save_nvram()
+            self.nvram_dirty.add(base // mmap.PAGESIZE)
+
+        # Invalidate text rows written in the video frame buffer
+        elif chip is self.isa:
+            offset = (base | (addr & 0xFF)) - CGA.FB_START
+            if 0 <= offset < CGA.FB_SIZE:
+                self.video_dirty.add(offset // 160)
+
+    def write_flat(self, addr, data):
+        self.write(addr, data)
+        self.window[addr] = data
 
     def load_rom(self, path):
         with open(path, "rb") as handle:
             data = handle.read()
             self.rom[:len(data)] = data
 
-    def load_nvram(self, path):
+        if self.flat:
+            self.load_window()
+
+    def load_nvram(self, path, copy=False):
         self.nvram_path = path
-        with open(self.nvram_path, "rb") as handle:
-            data = handle.read()
-            self.nvram[:len(data)] = data
+        self.nvram_handle = open(self.nvram_path, "rb" if copy else "r+b")
+
+        # Back NVRAM directly with the image so guest writes land in the page cache
+        if copy:
+            self.nvram_map = map_copy(self.nvram_handle, MMU.CHIP_SIZE)
+        else:
+            if os.path.getsize(self.nvram_path) < MMU.CHIP_SIZE:
+                self.nvram_handle.truncate(MMU.CHIP_SIZE)
 
-    def save_nvram(self):
-        with open(self.nvram_path, "wb") as handle:
-            handle.write(self.nvram)
+            self.nvram_map = mmap.mmap(self.nvram_handle.fileno(), MMU.CHIP_SIZE)
+        self.nvram = memoryview(self.nvram_map)
+        self.update_pages()
+
+    def sync_nvram(self, force=False):
+        if not self.nvram_dirty:
+            return
+
+        # Lazily flush only the pages changed since the last sync
+        if not force and (time.monotonic() - self.nvram_sync_time < MMU.NVRAM_SYNC_DELAY):
+            return
+
+        for page in sorted(self.nvram_dirty):
+            self.nvram_map.flush(page * mmap.PAGESIZE, mmap.PAGESIZE)
+
+        self.nvram_dirty.clear()
+        self.nvram_sync_time = time.monotonic()
 
     def load_tpa(self, path):
         with open(path, "rb") as handle:
@@ -173,13 +334,41 @@ class MMU:
 
             self.ram[0x100:0x100 + len(data)] = data
 
+        if self.flat:
+            self.load_window()
+
+    def get_state(self, store):
+        if self.flat:
+            self.sync_window()
+
+        return {
+            "registers": [ self.r_mapped, self.r_mode, self.r_pri_bank, self.r_isa_bank ],
+            "rom": store.save(self.rom), "ram": store.save(self.ram), "isa": store.save(self.isa), "nvram": store.save(self.nvram),
+        }
+
+    def set_state(self, state, store):
+        self.r_mapped, self.r_mode, self.r_pri_bank, self.r_isa_bank = state["registers"]
+        store.load(state["rom"], self.rom)
+        store.load(state["ram"], self.ram)
+        store.load(state["isa"], self.isa)
+        store.load(state["nvram"], self.nvram)
+
+        # Rebuild the mapping without syncing the stale window
+        self.update_pages(False)
+
 class CTC:
     PORT_BASE = 0x0010
+    PORTS = range(PORT_BASE, PORT_BASE + 4)
+    TICK_TIME = 0.05
+    TICK_CLOCKS = 256
 
-    def __init__(self, cpu, mmu):
+    def __init__(self, cpu, mmu, clock=7159000):
         self.cpu = cpu
         self.mmu = mmu
 
+        # CPU ticks per CTC clock, chosen so the BIOS timer (prescaler 256, constant 1) fires every 50ms
+        self.clock_divider = max(1, round(clock * CTC.TICK_TIME / CTC.TICK_CLOCKS))
+
         # Channel format [ trigger, scaler, mode, interrupt, constant ]
         # Mode: 0 = Timer, 1 = Counter
         # Trigger: 0 = Automatic, 1 = CLK/TRG Pulse
@@ -192,13 +381,13 @@ class CTC:
         self.active_int = None
         self.vector_base = 0x0000
         self.reti_active = False
+        self.clock_ticks = 0
+        self.interrupts = [ 0, 0, 0, 0 ]
+        self.scheduler = None
         self.cpu.set_reti_callback(self.reti_handler)
         self.cpu.set_get_int_vector_callback(self.int_vector_handler)
 
     def input(self, port):
-        if port & 0xFFFC != CTC.PORT_BASE & 0xFFFC:
-            return None
-
         channel = port & 0x000F
         if channel > 3:
             return None
@@ -206,9 +395,6 @@ class CTC:
         return self.channel_counts[channel]
 
     def output(self, port, data):
-        if port & 0xFFFC != CTC.PORT_BASE & 0xFFFC:
-            return False
-
         channel = port & 0x000F
         if channel > 3:
             return False
@@ -222,6 +408,10 @@ class CTC:
             if ((self.channel_configs[channel][0] == 0) or (self.channel_configs[channel][2] == 1)) and (self.channel_counts[channel] == -1):
                 self.channel_counts[channel] = self.channel_constants[channel]
 
+            # Pick up the new timing immediately
+            if self.scheduler is not None:
+                self.scheduler.reschedule()
+
             return True
 
         # Vector
@@ -250,39 +440,83 @@ class CTC:
 
             return True
 
-    def process_tick(self):
-        # Check for RETI        
-        if self.reti_active:
-            self.end_int_handler()
+    def get_event_ticks(self):
+        # While the interrupt line is held, retry at the rate of the CTC clock
+        if self.active_int == -1:
+            return self.clock_divider - self.clock_ticks
+
+        clocks = None
 
         for channel in range(4):
-            self.channel_scalers[channel] = (self.channel_scalers[channel] - 1) % 256
+            trigger, scaler, mode, interrupt = self.channel_configs[channel]
 
-            # Skip if channel is disabled
-            if self.channel_counts[channel] == -1:
+            # Only running timers with interrupts enabled produce events
+            if (self.channel_counts[channel] == -1) or (mode == 1) or not interrupt:
                 continue
 
-            # If timer mode, decrement if scaler at 0
-            if (self.channel_configs[channel][2] == 0) and ((self.channel_scalers[channel] % self.channel_configs[channel][1]) == 0):
-                self.channel_counts[channel] -= 1
+            # Clocks until the prescaler next rolls over, then once per prescaler period for the rest of the count
+            first = (self.channel_scalers[channel] % scaler) or scaler
+            channel_clocks = first + (self.channel_counts[channel] - 1) * scaler
 
-            # Process if count is 0
-            if self.channel_counts[channel] == 0:
-                # Raise interrupt if configured
-                if self.channel_configs[channel][3]:
-                    self.channel_interrupted[channel] = True
+            if (clocks is None) or (channel_clocks < clocks):
+                clocks = channel_clocks
+
+        if clocks is None:
+            return None
+
+        return clocks * self.clock_divider - self.clock_ticks
+
+    def process_ticks(self, ticks):
+        # Check for RETI
+        if self.reti_active:
+            self.end_int_handler()
+
+        # Convert CPU ticks to CTC clocks
+        self.clock_ticks += ticks
+        clocks = self.clock_ticks // self.clock_divider
+        self.clock_ticks %= self.clock_divider
 
-                # Automatically reset if in automatic trigger or counter mode
-                if (self.channel_configs[channel][0] == 0) or (self.channel_configs[channel][2] == 1):
-                    self.channel_counts[channel] = self.channel_constants[channel]
+        if clocks > 0:
+            for channel in range(4):
+                self.process_clocks(channel, clocks)
 
-            # If ready and triggered, indicate interrupt line being held but interrupt not yet assigned (-1)
-            if (self.active_int is None) and self.channel_interrupted[channel]:
-                self.active_int = -1
+        # If ready and triggered, indicate interrupt line being held but interrupt not yet assigned (-1)
+        if (self.active_int is None) and any(self.channel_interrupted):
+            self.active_int = -1
 
-            # While line held, continually signal interrupt to CPU
-            if (self.active_int == -1):
-                self.cpu.on_handle_active_int()
+        # While line held, continually signal interrupt to CPU
+        if (self.active_int == -1):
+            self.cpu.on_handle_active_int()
+
+    def process_clocks(self, channel, clocks):
+        trigger, scaler, mode, interrupt = self.channel_configs[channel]
+        prev_scaler = self.channel_scalers[channel]
+        self.channel_scalers[channel] = (prev_scaler - clocks) % 256
+
+        # Skip if channel is disabled or counting external events
+        if (self.channel_counts[channel] == -1) or (mode == 1):
+            return
+
+        # Timer mode decrements each time the prescaler rolls over
+        first = (prev_scaler % scaler) or scaler
+        if clocks < first:
+            return
+
+        steps = 1 + (clocks - first) // scaler
+        if steps < self.channel_counts[channel]:
+            self.channel_counts[channel] -= steps
+            return
+
+        # Count reached 0, raise interrupt if configured
+        if interrupt:
+            self.channel_interrupted[channel] = True
+
+        # Automatically reset if in automatic trigger mode, otherwise stop
+        if trigger == 0:
+            steps -= self.channel_counts[channel]
+            self.channel_counts[channel] = self.channel_constants[channel] - (steps % self.channel_constants[channel])
+        else:
+            self.channel_counts[channel] = -1
 
     def process_int(self, channel):
         # Ignore if channel is disabled
@@ -293,6 +527,13 @@ class CTC:
         if self.channel_configs[channel][2] == 1:
             self.channel_counts[channel] -= 1
 
+            # Raise interrupt if configured and automatically reset
+            if self.channel_counts[channel] == 0:
+                if self.channel_configs[channel][3]:
+                    self.channel_interrupted[channel] = True
+
+                self.channel_counts[channel] = self.channel_constants[channel]
+
         # If timer mode and count is 0, reset
         if (self.channel_configs[channel][2] == 0 ) and (self.channel_counts[channel] == 0):
             self.channel_counts[channel] = self.channel_constants[channel]
@@ -302,6 +543,7 @@ class CTC:
         for channel in range(4):
             if self.channel_interrupted[channel]:
                 self.active_int = channel
+                self.interrupts[channel] += 1
                 return self.vector_base + (2 * channel)
 
         return self.vector_base
@@ -320,8 +562,31 @@ class CTC:
     def reti_handler(self):
         self.reti_active = True
 
+    def get_state(self):
+        return {
+            "configs": [ list(config) for config in self.channel_configs ], "constants": list(self.channel_constants),
+            "counts": list(self.channel_counts), "scalers": list(self.channel_scalers), "waiting": list(self.channel_waiting),
+            "interrupted": list(self.channel_interrupted), "active_int": self.active_int, "vector_base": self.vector_base,
+            "reti_active": self.reti_active, "clock_ticks": self.clock_ticks,
+        }
+
+    def set_state(self, state):
+        self.channel_configs = [ list(config) for config in state["configs"] ]
+        self.channel_constants = list(state["constants"])
+        self.channel_counts = list(state["counts"])
+        self.channel_scalers = list(state["scalers"])
+        self.channel_waiting = list(state["waiting"])
+        self.channel_interrupted = list(state["interrupted"])
+        self.active_int = state["active_int"]
+        self.vector_base = state["vector_base"]
+        self.reti_active = state["reti_active"]
+        self.clock_ticks = state["clock_ticks"]
+
 class Keyboard:
     PORT_BASE = 0x0020
+    PORTS = range(PORT_BASE, PORT_BASE + 16)
+    IDLE_POLLS = 16
+    IDLE_GAP = 200
     CODE_TRANS = {
         "a": "\x1C", "b": "\x32", "c": "\x21", "d": "\x23",
         "e": "\x24", "f": "\x2B", "g": "\x34", "h": "\x33",
@@ -351,15 +616,20 @@ class Keyboard:
         "\x01": "\x14\x1C", "\x02": "\x14\x32", "\x03": "\x14\x21", "\x04": "\x14\x23",
     }
 
-    def __init__(self):
-        self.queue = queue.Queue()
+    def __init__(self, ctc=None, int_channel=None, idle_skip=True):
+        # Codes are only produced and consumed on the emulation thread
+        self.queue = collections.deque()
         self.cmd_active = False
         self.ack = 0x00
+        self.ctc = ctc
+        self.int_channel = int_channel
+        self.idle_skip = idle_skip
+        self.idle_polls = 0
+        self.idle_pc = None
+        self.idle_regs = None
+        self.idle_cycles = 0
 
     def input(self, port):
-        if port & 0xFFF0 != Keyboard.PORT_BASE & 0xFFF0:
-            return None
-
         channel = port & 0x000F
 
         if channel == 0:
@@ -372,9 +642,6 @@ class Keyboard:
             return self.ack
 
     def output(self, port, data):
-        if port & 0xFFF0 != Keyboard.PORT_BASE & 0xFFF0:
-            return False
-
         channel = port & 0x000F
 
         if channel == 1:
@@ -393,48 +660,147 @@ class Keyboard:
     def put_key(self, key):
         # Key down
         for code in Keyboard.CODE_TRANS[chr(key)]:
-            self.queue.put(ord(code))
+            self.queue.append(ord(code))
 
         # Key up 
         for code in Keyboard.CODE_TRANS[chr(key)]:
             if code != "\xE0":
-                self.queue.put(ord("\xF0"))
+                self.queue.append(ord("\xF0"))
+
+            self.queue.append(ord(code))
 
-            self.queue.put(ord(code))
+        # Optionally pulse a CTC counter channel's trigger so software can take keys by interrupt
+        if self.int_channel is not None:
+            self.ctc.process_int(self.int_channel)
 
     def get_code(self):
-        try:
-            code = self.queue.get(False)
-        except queue.Empty:
+        if self.queue:
+            code = self.queue.popleft()
+            self.idle_polls = 0
+        else:
             code = 0x00
+            self.check_idle()
+
+        if debug_log:
+            log("GET CODE: %s", code)
 
-        log(f"GET CODE: {code}")
         return code
 
+    def check_idle(self):
+        scheduler = self.ctc.scheduler if self.ctc is not None else None
+        if (scheduler is None) or not self.idle_skip:
+            return
+
+        # The same instruction reading an empty controller back to back, with nothing else changing, is a blocking wait for a key
+        cpu = scheduler.cpu
+        pc = cpu.pc
+        regs = (cpu.af, cpu.bc, cpu.de, cpu.hl, cpu.ix, cpu.iy, cpu.sp)
+        cycles = scheduler.get_cycles()
+
+        if (pc == self.idle_pc) and (regs == self.idle_regs) and (cycles - self.idle_cycles <= Keyboard.IDLE_GAP):
+            self.idle_polls += 1
+        else:
+            self.idle_polls = 0
+
+        self.idle_pc = pc
+        self.idle_regs = regs
+        self.idle_cycles = cycles
+
+        # Keys only arrive from the host between slices, so skip ahead instead of spinning
+        if self.idle_polls >= Keyboard.IDLE_POLLS:
+            self.idle_polls = 0
+            scheduler.skip_idle()
+
+    def get_state(self):
+        return { "queue": list(self.queue), "cmd_active": self.cmd_active, "ack": self.ack }
+
+    def set_state(self, state):
+        self.queue = collections.deque(state["queue"])
+        self.cmd_active = state["cmd_active"]
+        self.ack = state["ack"]
+
+class DiskGeometry:
+    def __init__(self, name, heads, tracks, sectors, sector_size):
+        self.name = name
+        self.heads = heads
+        self.tracks = tracks
+        self.sectors = sectors
+        self.sector_size = sector_size
+        self.size_code = (sector_size // 128).bit_length() - 1
+        self.track_size = sectors * sector_size
+        self.disk_size = heads * tracks * self.track_size
+
+        # Image files store tracks interleaved by head, precompute physical (head, track, sector) -> file offset
+        self.track_blocks = [ (track * heads) + head for head in range(heads) for track in range(tracks) ]
+        self.offsets = [ (block * sectors + sector) * sector_size for block in self.track_blocks for sector in range(sectors) ]
+
+    def get_offset(self, head, track, sector):
+        # Sectors are numbered from 1, None when the address is off the disk
+        if (head >= self.heads) or (track >= self.tracks) or (sector > self.sectors):
+            return None
+
+        # The ROM boot loader reads sector 0, which has always wrapped to the preceding physical sector
+        index = ((head * self.tracks) + track) * self.sectors + (sector - 1)
+        return self.offsets[index % len(self.offsets)]
+
+    def convert(self, data, physical=True):
+        # Reorder whole tracks between file (logical) order and physical head-major order
+        size = self.track_size
+        view = memoryview(data)
+        result = bytearray(len(view))
+
+        for index, block in enumerate(self.track_blocks):
+            src, dst = (block, index) if physical else (index, block)
+            result[dst * size:(dst + 1) * size] = view[src * size:(src + 1) * size]
+
+        return result
+
 class Floppy:
     PORT_BASE = 0x03F0
+    PORTS = range(PORT_BASE, PORT_BASE + 16)
     REG_DOR = 2
     REG_MSR = 4
     REG_DSR = 4
     REG_FIFO = 5
     REG_DIR = 7
     REG_CCR = 7
-    HEAD_COUNT = 2
-    TRACK_COUNT = 40
-    SECTORS_TRACK = 32
-    SECTOR_SIZE = 128
+    GEOMETRIES = {
+        "zisax": DiskGeometry("zisax", 2, 40, 32, 128),
+        "pc720": DiskGeometry("pc720", 2, 80, 9, 512),
+        "pc144": DiskGeometry("pc144", 2, 80, 18, 512),
+        "sssd8": DiskGeometry("sssd8", 1, 77, 26, 128),
+    }
+    DEFAULT_GEOMETRY = "zisax"
+    GEOMETRY_SUFFIX = ".geometry"
     DELAY = 1
     FAIL_RATE = 0.0
+    STATE = [ "initialized", "drive", "head", "tracks", "sector", "eot", "pos", "buffer", "motors", "rate", "nondma", "dio",
+              "rqm", "disk_change", "phase", "active_command", "command_byte", "locked", "sim_delay" ]
 
     @classmethod
-    def logical_physical_pos(cls, log_pos):
-        log_sector = log_pos // Floppy.SECTOR_SIZE
-        head = (log_sector // Floppy.SECTORS_TRACK) % 2
-        track = (log_sector // Floppy.SECTORS_TRACK) // 2
-        sector = log_sector % Floppy.SECTORS_TRACK
-        rel_pos = log_pos % Floppy.SECTOR_SIZE
+    def get_geometry(cls, path):
+        # A sidecar file names a geometry or gives "HEADS TRACKS SECTORS SECTOR_SIZE", otherwise match the image size
+        sidecar = path + Floppy.GEOMETRY_SUFFIX
+
+        if os.path.exists(sidecar):
+            with open(sidecar, "r") as handle:
+                fields = handle.read().split()
+
+            if (len(fields) == 1) and (fields[0] in Floppy.GEOMETRIES):
+                return Floppy.GEOMETRIES[fields[0]]
+
+            if len(fields) == 4:
+                return DiskGeometry("custom", *[ int(field) for field in fields ])
+
+            raise ValueError(f"Invalid geometry in {sidecar}")
 
-        return (head * Floppy.TRACK_COUNT * Floppy.SECTORS_TRACK * Floppy.SECTOR_SIZE) + (track * Floppy.SECTORS_TRACK * Floppy.SECTOR_SIZE) + (sector * Floppy.SECTOR_SIZE) + rel_pos
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        for geometry in Floppy.GEOMETRIES.values():
+            if geometry.disk_size == size:
+                return geometry
+
+        # Short or unknown images are treated as (padded) ZISA-X disks
+        return Floppy.GEOMETRIES[Floppy.DEFAULT_GEOMETRY]
 
     def __init__(self):
         self.initialized = False
@@ -442,7 +808,9 @@ class Floppy:
         self.head = 0
         self.tracks = [ 0, 0, 0, 0 ]
         self.sector = 0
+        self.eot = 0
         self.pos = 0
+        self.buffer = bytearray(Floppy.GEOMETRIES[Floppy.DEFAULT_GEOMETRY].sector_size)
         self.motors = [ False, False, False, False ]
         self.rate = 500
         self.nondma = False
@@ -454,20 +822,68 @@ class Floppy:
         self.command_byte = 0
         self.locked = False
         self.sim_delay = 1
-        self.images = [[0x00] * self.get_max_count(), [0x00] * self.get_max_count(), [0x00] * self.get_max_count(), [0x00] * self.get_max_count()]
+        self.images = [ None, None, None, None ]
+        self.handles = [ None, None, None, None ]
         self.paths = [ "", "", "", "" ]
+        self.geometries = [ Floppy.GEOMETRIES[Floppy.DEFAULT_GEOMETRY] ] * 4
+        self.sectors_read = [ 0, 0, 0, 0 ]
+        self.sectors_written = [ 0, 0, 0, 0 ]
+
+    def get_sector_pos(self):
+        return self.geometries[self.drive].get_offset(self.head, self.tracks[self.drive], self.sector)
+
+    def get_sector_size(self):
+        return self.geometries[self.drive].sector_size
+
+    def stage_sector(self):
+        self.pos = 0
+
+        # Writes are collected into an empty buffer and committed once full
+        if self.active_command == "WRITE":
+            self.buffer = bytearray(self.get_sector_size())
+            return
+
+        if not self.motors[self.drive]:
+            log("WARNING: Reading data from FIFO during READ without motor on ");
+
+        pos = self.get_sector_pos()
+
+        if (self.images[self.drive] is None) or (pos is None):
+            self.buffer = bytes(self.get_sector_size())
+        else:
+            self.buffer = self.images[self.drive][pos:pos + self.get_sector_size()]
+
+        self.sectors_read[self.drive] += 1
+
+        if debug_log:
+            log("Floppy: Read - Drive %s Head %s Track %s Sector %s", self.drive, self.head, self.tracks[self.drive], self.sector)
+
+    def commit_sector(self):
+        if not self.motors[self.drive]:
+            log("WARNING: Writing data to FIFO during WRITE without motor on");
+
+        pos = self.get_sector_pos()
+
+        if (self.images[self.drive] is not None) and (pos is not None):
+            self.images[self.drive][pos:pos + self.get_sector_size()] = self.buffer
+            self.sync_sector()
+
+        self.sectors_written[self.drive] += 1
 
-    def get_pos(self):
-        pos = self.head * Floppy.TRACK_COUNT * Floppy.SECTORS_TRACK * Floppy.SECTOR_SIZE
-        pos += self.tracks[self.drive] * Floppy.SECTORS_TRACK * Floppy.SECTOR_SIZE
-        pos += (self.sector - 1) * Floppy.SECTOR_SIZE
-        pos += self.pos
-        self.pos += 1
+        if debug_log:
+            log("Floppy: Write - Drive %s Head %s Track %s Sector %s", self.drive, self.head, self.tracks[self.drive], self.sector)
 
-        return pos
+    def next_sector(self):
+        # Continue multi-sector transfers until EOT is reached
+        if self.sector >= self.eot:
+            return False
+
+        self.sector += 1
+        self.stage_sector()
+        return True
 
-    def get_max_count(self):
-        return Floppy.HEAD_COUNT * Floppy.TRACK_COUNT * Floppy.SECTORS_TRACK * Floppy.SECTOR_SIZE
+    def get_max_count(self, drive):
+        return self.geometries[drive].disk_size
 
     def get_sim_rqm(self):
         if (self.active_command is not None) and (self.sim_delay % Floppy.DELAY != 0):
@@ -532,14 +948,16 @@ class Floppy:
                 return
 
             if self.command_byte == 5:
-                if data != 0x00:
-                    log(f"WARNING: Incorrect sector size during READ: {data}");
+                if data != self.geometries[self.drive].size_code:
+                    log("WARNING: Incorrect sector size during READ: %s", data);
                 self.command_byte += 1
                 return
 
             if self.command_byte == 6:
-                if data != self.sector:
-                    log(f"WARNING: EOT not set to correct sector during READ: {data}");
+                sectors = self.geometries[self.drive].sectors
+                if (data < self.sector) or (data > sectors):
+                    log("WARNING: EOT not set to correct sector during READ: %s", data);
+                self.eot = min(max(data, self.sector), sectors)
                 self.command_byte += 1
                 return
 
@@ -549,12 +967,13 @@ class Floppy:
                 return
 
             if self.command_byte == 8:
-                if data != Floppy.SECTOR_SIZE:
-                    log(f"WARNING: DTL incorrect size during READ: {data}");
+                # DTL only applies to 128 byte sectors
+                if (self.geometries[self.drive].size_code == 0) and (data != self.get_sector_size()):
+                    log("WARNING: DTL incorrect size during READ: %s", data);
                 self.phase = 1
                 self.dio = 1
                 self.nondma = True
-                self.pos = 0
+                self.stage_sector()
 
                 # Immediately indicate the FIFO is "filled"
                 self.rqm = True
@@ -562,18 +981,15 @@ class Floppy:
 
         if self.phase == 1:
             # Invalid
-            log(f"WARNING: Writing data to FIFO during READ execution phase");
+            log("WARNING: Writing data to FIFO during READ execution phase");
             return
 
     def process_read_input(self):
         if self.phase == 1:
-            if not self.motors[self.drive]:
-                log(f"WARNING: Reading data from FIFO during READ without motor on ");
+            val = self.buffer[self.pos]
+            self.pos += 1
 
-            val = self.images[self.drive][self.get_pos()]
-            log(f"Floppy: Read - Drive {self.drive} Head {self.head} Track {self.tracks[self.drive]} Sector {self.sector} Pos {self.pos}")
-
-            if self.pos >= Floppy.SECTOR_SIZE:
+            if (self.pos >= len(self.buffer)) and not self.next_sector():
                 self.phase = 2
                 self.rqm = True
                 self.nondma = False
@@ -585,8 +1001,8 @@ class Floppy:
             if self.command_byte == 0:
                 self.command_byte += 1
 
-                # Fail operation if no disk in drive
-                read_fail = self.paths[self.drive] == ""
+                # Fail operation if no disk in drive or the sector is off the disk
+                read_fail = (self.paths[self.drive] == "") or (self.get_sector_pos() is None)
 
                 # Fail operation at virtual failure rate
                 read_fail = read_fail or (random.random() < Floppy.FAIL_RATE)
@@ -648,14 +1064,16 @@ class Floppy:
                 return
 
             if self.command_byte == 5:
-                if data != 0x00:
-                    log(f"WARNING: Incorrect sector size during WRITE: {data}");
+                if data != self.geometries[self.drive].size_code:
+                    log("WARNING: Incorrect sector size during WRITE: %s", data);
                 self.command_byte += 1
                 return
 
             if self.command_byte == 6:
-                if data != self.sector:
-                    log(f"WARNING: EOT not set to correct sector during WRITE: {data}");
+                sectors = self.geometries[self.drive].sectors
+                if (data < self.sector) or (data > sectors):
+                    log("WARNING: EOT not set to correct sector during WRITE: %s", data);
+                self.eot = min(max(data, self.sector), sectors)
                 self.command_byte += 1
                 return
 
@@ -665,25 +1083,28 @@ class Floppy:
                 return
 
             if self.command_byte == 8:
-                if data != Floppy.SECTOR_SIZE:
-                    log(f"WARNING: DTL incorrect size during WRITE: {data}");
+                # DTL only applies to 128 byte sectors
+                if (self.geometries[self.drive].size_code == 0) and (data != self.get_sector_size()):
+                    log("WARNING: DTL incorrect size during WRITE: %s", data);
                 self.phase = 1
                 self.dio = 0
                 self.nondma = True
-                self.pos = 0
+                self.stage_sector()
 
                 # Immediately indicate the FIFO is "empty"
                 self.rqm = True
                 return
 
         if self.phase == 1:
-            if not self.motors[self.drive]:
-                log(f"WARNING: Writing data to FIFO during WRITE without motor on");
+            self.buffer[self.pos] = data
+            self.pos += 1
 
-            self.images[self.drive][self.get_pos()] = data
-            log(f"Floppy: Write - Drive {self.drive} Head {self.head} Track {self.tracks[self.drive]} Sector {self.sector} Pos {self.pos}")
+            if self.pos < len(self.buffer):
+                return
 
-            if self.pos >= Floppy.SECTOR_SIZE:
+            self.commit_sector()
+
+            if not self.next_sector():
                 self.phase = 2
                 self.dio = 1
                 self.rqm = True
@@ -697,8 +1118,8 @@ class Floppy:
             if self.command_byte == 0:
                 self.command_byte += 1
 
-                # Fail operation if no disk in drive
-                write_fail = self.paths[self.drive] == ""
+                # Fail operation if no disk in drive or the sector is off the disk
+                write_fail = (self.paths[self.drive] == "") or (self.get_sector_pos() is None)
 
                 # Fail operation at virtual failure rate
                 write_fail = write_fail or (random.random() < Floppy.FAIL_RATE)
@@ -739,15 +1160,15 @@ class Floppy:
                 return
 
             if self.command_byte == 1:
-                log(f"Floppy specify: SRT: {(data >> 4) & 0x0F}, HUT: {data & 0x0F}")
+                log("Floppy specify: SRT: %s, HUT: %s", (data >> 4) & 0x0F, data & 0x0F)
                 self.command_byte += 1
                 return
 
             if self.command_byte == 2:
                 if not bits[0]:
-                    log(f"WARNING: ND incorrect: {bits[0]}");
+                    log("WARNING: ND incorrect: %s", bits[0]);
 
-                log(f"Floppy specify: HLT: {data >> 1}")
+                log("Floppy specify: HLT: %s", data >> 1)
                 self.init_command()
                 return
 
@@ -763,23 +1184,23 @@ class Floppy:
 
             if self.command_byte == 2:
                 if not bits[6]:
-                    log(f"WARNING: EIS incorrect : {bits[6]}");
+                    log("WARNING: EIS incorrect : %s", bits[6]);
 
                 if bits[5]:
-                    log(f"WARNING: EFIFO incorrect : {bits[5]}");
+                    log("WARNING: EFIFO incorrect : %s", bits[5]);
 
                 if bits[4]:
-                    log(f"WARNING: POLL incorrect : {bits[4]}");
+                    log("WARNING: POLL incorrect : %s", bits[4]);
 
                 if (data & 0x0F) != 10:
-                    log(f"WARNING: FIFOTHR incorrect : {data & 0x0F}");
+                    log("WARNING: FIFOTHR incorrect : %s", data & 0x0F);
 
                 self.command_byte += 1
                 return
 
             if self.command_byte == 3:
                 if data != 0:
-                    log(f"WARNING: PRETRK incorrect : {data & 0x0F}");
+                    log("WARNING: PRETRK incorrect : %s", data & 0x0F);
                 self.init_command()
                 return
 
@@ -792,7 +1213,7 @@ class Floppy:
             if self.command_byte == 1:
                 self.drive = data & 0x03
                 if not self.motors[self.drive]:
-                    log(f"WARNING: Recalibrate without running motor {self.drive} {self.motors[self.drive]}");
+                    log("WARNING: Recalibrate without running motor %s %s", self.drive, self.motors[self.drive]);
                 self.tracks[self.drive] = 0
 
                 self.init_command()
@@ -809,28 +1230,44 @@ class Floppy:
             self.init_command()
             return int(self.locked) << 4
 
-    def load_image(self, drive):
-        with open(self.paths[drive], "rb") as handle:
-            data = handle.read()
-            for log_pos in range(len(data)):
-                phys_pos = Floppy.logical_physical_pos(log_pos)
-                self.images[drive][phys_pos] = data[log_pos]
+    def load_image(self, drive, copy=False):
+        self.geometries[drive] = Floppy.get_geometry(self.paths[drive])
+        self.handles[drive] = open(self.paths[drive], "rb" if copy else "r+b")
+        size = self.get_max_count(drive)
+
+        # Map the image in place, padding short images to a full disk
+        if copy:
+            self.images[drive] = map_copy(self.handles[drive], size)
+            return
+
+        if os.path.getsize(self.paths[drive]) < size:
+            self.handles[drive].truncate(size)
+
+        self.images[drive] = mmap.mmap(self.handles[drive].fileno(), size)
+
+    def sync_sector(self):
+        if self.images[self.drive] is None:
+            return
+
+        # Flush from the page holding the current sector to its end so writes are durable immediately
+        pos = self.get_sector_pos()
+        page = pos & ~(mmap.PAGESIZE - 1)
+        self.images[self.drive].flush(page, pos + self.get_sector_size() - page)
 
     def save_image(self, drive):
-        with open(self.paths[drive], "wb") as handle:
-            file_bytes = bytearray(self.get_max_count())
-            for log_pos in range(len(file_bytes)):
-                phys_pos = Floppy.logical_physical_pos(log_pos)
-                file_bytes[log_pos] = self.images[drive][phys_pos]
+        if self.images[drive] is None:
+            return
 
-            handle.write(file_bytes)
+        self.images[drive].flush()
 
     def input(self, port):
-        if port & 0xFFF0 != Floppy.PORT_BASE & 0xFFF0:
-            return None
-
         register = port & 0x000F
 
+        # Fast path for data bytes during the READ execution phase
+        if (register == Floppy.REG_FIFO) and (self.phase == 1) and (self.dio == 1) and self.get_sim_rqm():
+            self.sim_delay = (self.sim_delay + 1) % Floppy.DELAY
+            return self.process_read_input()
+
         if register == Floppy.REG_DOR:
             val = [ (self.drive & 0x01) > 0, (self.drive & 0x02) > 0, False, False, self.motors[0], self.motors[1], self.motors[2], self.motors[3] ]
             return int("".join([ str(int(x)) for x in reversed(val) ]), 2)
@@ -846,15 +1283,15 @@ class Floppy:
         if register == Floppy.REG_FIFO:
             # Report invalid operations
             if self.dio == 0:
-                log(f"WARNING: Reading data from FIFO while DIO set to 0");
+                log("WARNING: Reading data from FIFO while DIO set to 0");
                 return 0
 
             if not self.get_sim_rqm():
-                log(f"WARNING: Reading data from FIFO while RQM set to 0");
+                log("WARNING: Reading data from FIFO while RQM set to 0");
                 return 0
 
             if self.phase == 0:
-                log(f"WARNING: Reading data from FIFO during command phase");
+                log("WARNING: Reading data from FIFO during command phase");
                 return 0
 
             # Simulate delay processing command
@@ -876,16 +1313,20 @@ class Floppy:
             return int(self.disk_change) << 7
 
     def output(self, port, data):
-        if port & 0xFFF0 != Floppy.PORT_BASE & 0xFFF0:
-            return False
-
         register = port & 0x000F
+
+        # Fast path for data bytes during the WRITE execution phase
+        if (register == Floppy.REG_FIFO) and (self.phase == 1) and (self.dio == 0) and self.get_sim_rqm():
+            self.sim_delay = (self.sim_delay + 1) % Floppy.DELAY
+            self.process_write_output(data, None)
+            return True
+
         bits = [ False if (data & 2**x) == 0 else True for x in range(8) ]
 
         if register == Floppy.REG_DOR:
             for x in range(4):
                 if self.motors[x] != bits[4 + x]:
-                    log(f"Floppy: motor {x} status changed: {bits[4 + x]}")
+                    log("Floppy: motor %s status changed: %s", x, bits[4 + x])
 
             self.motors[0], self.motors[1], self.motors[2], self.motors[3] = bits[4:]
             self.drive = 2 * int(bits[1]) + int(bits[0])
@@ -899,7 +1340,7 @@ class Floppy:
             if bits[7]:
                 log("Floppy: Reset")
                 if self.initialized and not self.locked:
-                    log(f"WARNING: Reset without lock active");
+                    log("WARNING: Reset without lock active");
                 self.init_command()
                 self.initialized = True
 
@@ -908,21 +1349,21 @@ class Floppy:
         if register == Floppy.REG_FIFO:
             # Report invalid operations
             if self.dio == 1:
-                log(f"Floppy Warning: Writing data to FIFO while DIO set to 1");
+                log("Floppy Warning: Writing data to FIFO while DIO set to 1");
                 return True
 
             if not self.get_sim_rqm():
-                log(f"Floppy Warning: Writing data to FIFO while RQM set to 0");
+                log("Floppy Warning: Writing data to FIFO while RQM set to 0");
                 return True
 
             if self.phase == 2:
-                log(f"Floppy Warning: Writing data to FIFO during result phase");
+                log("Floppy Warning: Writing data to FIFO during result phase");
                 return True
 
             # Check for start of new command
             if (self.phase == 0) and (self.active_command is None):
                 self.start_command(data)
-                log(f"Floppy: Command={self.active_command}")
+                log("Floppy: Command=%s", self.active_command)
 
             # Simulate delay processing command
             self.sim_delay = (self.sim_delay + 1) % Floppy.DELAY
@@ -957,9 +1398,25 @@ class Floppy:
 
         return True
 
+    def get_state(self):
+        # Controller state only, disk contents live in the image files
+        state = { name: getattr(self, name) for name in Floppy.STATE }
+        state["buffer"] = bytes(self.buffer).hex()
+        return state
+
+    def set_state(self, state):
+        for name in Floppy.STATE:
+            setattr(self, name, state[name])
+
+        self.tracks = list(self.tracks)
+        self.motors = list(self.motors)
+        self.buffer = bytearray.fromhex(self.buffer)
+
 class CGA:
     FB_START = 0xB8000
+    FB_SIZE = 4000
     PORT_BASE = 0x03D0
+    PORTS = range(PORT_BASE, PORT_BASE + 16)
 
     @classmethod
     def get_color(cls, attr):
@@ -994,18 +1451,22 @@ class CGA:
             for back in range(8):
                 curses.init_pair(fore * 8 + back, fore, back)
 
-    def input(self, port):
-        if port & 0xFFF0 != CGA.PORT_BASE & 0xFFF0:
-            return None
+        # Precompute curses attributes for all CGA attributes
+        self.colors = [ CGA.get_color(attr) for attr in range(256) ]
+
+        # Shadow copy of the frame buffer as last drawn
+        self.dirty = True
+        self.shadow = bytearray(CGA.FB_SIZE)
+        self.shadow_valid = False
+        self.shadow_cursor = None
+        self.frames = 0
 
+    def input(self, port):
         channel = port & 0x000F
 
         return 0x00
 
     def output(self, port, data):
-        if port & 0xFFF0 != CGA.PORT_BASE & 0xFFF0:
-            return False
-
         channel = port & 0x000F
 
         if channel == 4:
@@ -1015,6 +1476,7 @@ class CGA:
         if channel == 5:
             if self.control_mode == 0x0F: self.cursor_low = data
             if self.control_mode == 0x0E: self.cursor_high = data
+            self.dirty = True
             return True
 
         return False
@@ -1025,179 +1487,950 @@ class CGA:
         cursor_y = abs_pos // 80
         self.stdscr.move(cursor_y, cursor_x)
 
-    def render(self):
-        for y in range(25):
-            for x in range(80):
-                char = self.memory[CGA.FB_START + (y * 160) + (x * 2)]
-                attr = self.memory[CGA.FB_START + (y * 160) + (x * 2) + 1]
+    def render(self, rows=None):
+        frame = self.memory[CGA.FB_START:CGA.FB_START + CGA.FB_SIZE]
+        cursor = (self.cursor_high << 8) | (self.cursor_low)
+        changed = False
+        self.dirty = False
+
+        # Redraw everything until the shadow is populated, otherwise only the given rows
+        if (rows is None) or not self.shadow_valid:
+            rows = range(25)
+
+        for y in sorted(rows):
+            start = y * 160
+            row = frame[start:start + 160]
+
+            # Skip rows unchanged since the last frame
+            if self.shadow_valid and (row == self.shadow[start:start + 160]):
+                continue
+
+            for x in range(0, 160, 2):
+                char = row[x]
+                attr = row[x + 1]
+
+                if self.shadow_valid and (char == self.shadow[start + x]) and (attr == self.shadow[start + x + 1]):
+                    continue
+
                 rchar = 0x20 if char == 0x00 else char
-                self.stdscr.addch(y, x, chr(rchar), CGA.get_color(attr))
-                self.set_cursor()
+                self.stdscr.addch(y, x // 2, chr(rchar), self.colors[attr])
+
+            self.shadow[start:start + 160] = row
+            changed = True
+
+        self.shadow_valid = True
+
+        if not changed and (cursor == self.shadow_cursor):
+            return
 
+        self.set_cursor()
+        self.shadow_cursor = cursor
         self.stdscr.noutrefresh()
         curses.doupdate()
+        self.frames += 1
+
+    def get_state(self):
+        return { "control_mode": self.control_mode, "cursor_high": self.cursor_high, "cursor_low": self.cursor_low }
+
+    def set_state(self, state):
+        self.control_mode = state["control_mode"]
+        self.cursor_high = state["cursor_high"]
+        self.cursor_low = state["cursor_low"]
+        self.dirty = True
+
+class TextScreen(CGA):
+    def __init__(self, memory):
+        # Same registers as the CGA, but the frame buffer is only read back as text
+        self.memory = memory
+        self.control_mode = 0x00
+        self.cursor_high = 0x00
+        self.cursor_low = 0x00
+        self.dirty = True
+        self.frames = 0
+
+    def get_rows(self):
+        frame = bytes(self.memory[CGA.FB_START:CGA.FB_START + CGA.FB_SIZE:2]).replace(b"\x00", b" ")
+        return [ frame[y * 80:(y + 1) * 80].decode("cp437") for y in range(25) ]
 
-def log(message, dest="debug"):
-    if dest == "debug":
-        if not args.debug: return
-        path = "debug.txt"
+    def get_text(self):
+        return "\n".join(row.rstrip() for row in self.get_rows()).rstrip("\n") + "\n"
 
-    if dest == "trace":
-        if not args.trace: return
-        path = "trace.txt"
+    def get_prompt(self):
+        # Text on the cursor row up to the cursor
+        abs_pos = (self.cursor_high << 8) | (self.cursor_low)
+        return self.get_rows()[(abs_pos // 80) % 25][:abs_pos % 80].rstrip()
+
+class InputReader:
+    def __init__(self, fd):
+        # Watch the terminal on a background thread so the emulation loop only checks a flag
+        self.fd = fd
+        self.ready = False
+        self.wake = threading.Event()
+        self.drained = threading.Event()
+        self.drained.set()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            self.drained.wait()
+            readable, _, _ = select.select([ self.fd ], [], [])
+
+            if readable:
+                self.drained.clear()
+                self.ready = True
+                self.wake.set()
+
+    def done(self):
+        # Called once pending input has been consumed
+        self.ready = False
+        self.wake.clear()
+        self.drained.set()
+
+class IOBus:
+    PORT_COUNT = 0x10000
+
+    def __init__(self):
+        # Port -> bound component handler
+        self.inputs = [ None ] * IOBus.PORT_COUNT
+        self.outputs = [ None ] * IOBus.PORT_COUNT
+        self.names = [ "unhandled" ] * IOBus.PORT_COUNT
+        self.unhandled_inputs = collections.Counter()
+        self.unhandled_outputs = collections.Counter()
+
+    def attach(self, component):
+        for port in component.PORTS:
+            self.inputs[port] = component.input
+            self.outputs[port] = component.output
+            self.names[port] = type(component).__name__.lower()
+
+    def input(self, port):
+        handler = self.inputs[port]
 
-    with open(path, "a") as handle:
-        handle.write(f"{message}\n")
+        if handler is not None:
+            val = handler(port)
+            if val is not None:
+                return val
 
-def parse_args():
+        self.unhandled_inputs[port] += 1
+        return 0x00
+
+    def output(self, port, data):
+        handler = self.outputs[port]
+
+        if (handler is None) or not handler(port, data):
+            self.unhandled_outputs[port] += 1
+
+class Scheduler:
+    MAX_SLICE = 20000
+    MIN_SLEEP = 0.001
+    MAX_LAG = 0.25
+    IDLE_TIME = 0.1
+
+    def __init__(self, cpu, ctc, clock=7159000, turbo=False):
+        self.cpu = cpu
+        self.ctc = ctc
+        self.ctc.scheduler = self
+        self.cycles = 0
+        self.slice_ticks = 0
+        self.running = False
+        self.exit_pending = False
+        self.idle_pending = False
+        self.idle_cycles = 0
+        self.wake = None
+        self.clock = clock
+        self.set_turbo(turbo)
+
+    def run(self, limit=MAX_SLICE):
+        # A halted CPU only waits for an interrupt, so go straight to the next event
+        if self.cpu._Z80State__halted[0] > 0:
+            self.skip_to_event()
+
+        else:
+            self.run_slice(limit)
+
+            # Fast-forward over a guest idle loop up to the next event, as if it had kept spinning
+            if self.idle_pending:
+                self.idle_pending = False
+                self.skip_to_event()
+
+        if self.exit_pending:
+            sys.exit(0)
+
+        if not self.turbo:
+            self.pace()
+
+    def run_slice(self, limit):
+        # Run the CPU exactly up to the next CTC event
+        ticks = self.ctc.get_event_ticks()
+        if (ticks is None) or (ticks > limit):
+            ticks = limit
+
+        self.slice_ticks = max(1, ticks)
+        self.cpu.ticks_to_stop = self.slice_ticks
+        self.running = True
+        self.cpu.run()
+        self.running = False
+
+        # The core may stop early, count only the ticks actually executed
+        elapsed = self.slice_ticks - self.cpu.ticks_to_stop
+        self.cycles += elapsed
+        self.ctc.process_ticks(elapsed)
+
+    def skip_to_event(self):
+        # Without a pending event the skip is bounded so the loop still polls the host
+        ticks = self.ctc.get_event_ticks()
+        if ticks is None:
+            ticks = int(self.clock * Scheduler.IDLE_TIME)
+
+        ticks = max(1, ticks)
+        self.cycles += ticks
+        self.idle_cycles += ticks
+        self.ctc.process_ticks(ticks)
+
+    def pace(self):
+        # Hold the executed cycles to real time at the guest clock
+        target = self.pace_time + (self.cycles - self.pace_cycles) / self.clock
+        delay = target - time.monotonic()
+
+        if delay >= Scheduler.MIN_SLEEP:
+            # Host input cuts the wait short so keys are seen while the guest idles
+            if self.wake is not None:
+                self.wake.wait(delay)
+            else:
+                time.sleep(delay)
+
+        # Don't try to catch up after falling far behind (host load, slow callbacks)
+        elif delay < -Scheduler.MAX_LAG:
+            self.resync()
+
+    def resync(self):
+        self.pace_time = time.monotonic()
+        self.pace_cycles = self.cycles
+
+    def set_turbo(self, turbo):
+        self.turbo = turbo
+        self.resync()
+
+    def get_cycles(self):
+        # Cycles including the part of the running slice executed so far
+        if self.running:
+            return self.cycles + self.slice_ticks - self.cpu.ticks_to_stop
+
+        return self.cycles
+
+    def skip_idle(self):
+        self.idle_pending = True
+        self.reschedule()
+
+    def reschedule(self):
+        # End the running slice after the current instruction
+        remaining = self.cpu.ticks_to_stop
+        if remaining > 1:
+            self.slice_ticks -= remaining - 1
+            self.cpu.ticks_to_stop = 1
+
+class Tracer:
+    MAGIC = b"ZXTR"
+    HEADER = struct.Struct("<4sII")
+    RECORD = struct.Struct("<BBHHBHHHHH")
+
+    def __init__(self, cpu, mmu, size):
+        self.cpu = cpu
+        self.mmu = mmu
+        self.size = size
+        self.buffer = bytearray(Tracer.RECORD.size * size)
+        self.index = 0
+        self.count = 0
+        self.halted = False
+
+    def record(self):
+        # Fixed size binary record per instruction, oldest entries are overwritten
+        cpu = self.cpu
+        Tracer.RECORD.pack_into(self.buffer, self.index * Tracer.RECORD.size, self.mmu.r_mode, self.mmu.r_pri_bank,
+                                cpu.pc, cpu.sp, cpu.a, cpu.bc, cpu.de, cpu.hl, cpu.ix, cpu.iy)
+
+        self.index = (self.index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def dump(self, path):
+        # Write records oldest first
+        start = (self.index - self.count) % self.size
+        split = min(self.count, self.size - start)
+
+        with open(path, "wb") as handle:
+            handle.write(Tracer.HEADER.pack(Tracer.MAGIC, Tracer.RECORD.size, self.count))
+            handle.write(self.buffer[start * Tracer.RECORD.size:(start + split) * Tracer.RECORD.size])
+            handle.write(self.buffer[:(self.count - split) * Tracer.RECORD.size])
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as handle:
+            magic, size, count = Tracer.HEADER.unpack(handle.read(Tracer.HEADER.size))
+            if (magic != Tracer.MAGIC) or (size != Tracer.RECORD.size):
+                raise ValueError(f"Not a ZISA-X trace: {path}")
+
+            for _ in range(count):
+                yield Tracer.RECORD.unpack(handle.read(size))
+
+class Profiler:
+    SYMBOL_LINE = re.compile(r"^\s*([\w.$?@]+):?\s+(?:equ|EQU|\.equ|=)\s+(?:\$|0x)?([0-9A-Fa-f]+)h?\b")
+    TOP_COUNT = 40
+
+    def __init__(self, cpu, mmu, interval):
+        self.cpu = cpu
+        self.mmu = mmu
+        self.interval = interval
+        self.next_cycles = None
+        self.samples = collections.Counter()
+
+    def sample(self, cycles):
+        # Start at the next multiple of the interval, the clock may not begin at zero after a state load
+        if self.next_cycles is None:
+            self.next_cycles = (cycles // self.interval + 1) * self.interval
+            return
+
+        if cycles < self.next_cycles:
+            return
+
+        # One sample per interval boundary passed, a long (idle) slice counts for every boundary it covered
+        count = (cycles - self.next_cycles) // self.interval + 1
+        self.next_cycles += count * self.interval
+
+        # Histogram keyed like get_regs: mode, bank, PC
+        self.samples[(self.mmu.r_mode, self.mmu.r_pri_bank, self.cpu.pc)] += count
+
+    @classmethod
+    def load_symbols(cls, spec):
+        # PATH[,MODE[,BANK]], symbols without a mode or bank apply to all of them
+        path, *where = spec.split(",")
+        mode = int(where[0], 0) if len(where) > 0 else None
+        bank = int(where[1], 0) if len(where) > 1 else None
+        symbols = []
+
+        with open(path, "r") as handle:
+            for line in handle:
+                match = Profiler.SYMBOL_LINE.match(line)
+                if match:
+                    symbols.append((int(match.group(2), 16), match.group(1)))
+
+        symbols.sort()
+        return (mode, bank, [ addr for addr, _ in symbols ], [ name for _, name in symbols ])
+
+    @classmethod
+    def get_region(cls, pc):
+        for section, (start, stop) in SECTIONS.items():
+            if start <= pc < stop:
+                return section
+
+        return "Unknown"
+
+    @classmethod
+    def get_symbol(cls, symbols, mode, bank, pc):
+        # Nearest preceding label from the first symbol table matching the bank
+        for sym_mode, sym_bank, addrs, names in symbols:
+            if ((sym_mode is not None) and (sym_mode != mode)) or ((sym_bank is not None) and (sym_bank != bank)):
+                continue
+
+            index = bisect.bisect_right(addrs, pc) - 1
+            if index >= 0:
+                return names[index], pc - addrs[index]
+
+        return None, 0
+
+    def write_report(self, path, symbols):
+        total = sum(self.samples.values()) or 1
+        banks = collections.Counter()
+        regions = collections.Counter()
+        folded = collections.Counter()
+
+        for (mode, bank, pc), count in self.samples.items():
+            region = Profiler.get_region(pc)
+            name, _ = Profiler.get_symbol(symbols, mode, bank, pc)
+            banks[f"{mode}:{bank}"] += count
+            regions[(f"{mode}:{bank}", region)] += count
+            folded[f"{mode}:{bank};{region};{name or hex(pc)}"] += count
+
+        with open(path, "w") as handle:
+            handle.write(f"Samples: {total} (PC at the end of the slice that passes each multiple of {self.interval} cycles)\n\nBANK (MODE:BANK)\n")
+
+            for bank, count in banks.most_common():
+                handle.write(f"{count / total:7.2%} {count:9} {bank}\n")
+
+            handle.write("\nREGION\n")
+            for (bank, region), count in regions.most_common():
+                handle.write(f"{count / total:7.2%} {count:9} {bank} {region}\n")
+
+            handle.write("\nTOP\n")
+            for (mode, bank, pc), count in self.samples.most_common(Profiler.TOP_COUNT):
+                name, offset = Profiler.get_symbol(symbols, mode, bank, pc)
+                label = f"{name}+{offset:#x}" if name else ""
+                handle.write(f"{count / total:7.2%} {count:9} PC:{mode}:{bank}:{pc:04x} {Profiler.get_region(pc)} {label}".rstrip() + "\n")
+
+        # Folded stacks for flamegraph.pl / speedscope
+        with open(f"{path}.folded", "w") as handle:
+            for stack, count in sorted(folded.items()):
+                handle.write(f"{stack} {count}\n")
+
+class PageStore:
+    PAGE_SIZE = 4096
+    ZERO_PAGE = bytes(PAGE_SIZE)
+    KEY = re.compile(r"[0-9a-f]{32}")
+
+    def __init__(self, path=None):
+        # Pages are kept in memory, or as one compressed file per page when a directory is given
+        self.path = path
+        self.pages = {}
+
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def put(self, page):
+        # Zero pages are never stored, everything else is keyed by content
+        if page == PageStore.ZERO_PAGE[:len(page)]:
+            return None
+
+        key = hashlib.blake2b(page, digest_size=16).hexdigest()
+        if key in self.pages:
+            return key
+
+        if self.path:
+            page_path = os.path.join(self.path, key)
+            if not os.path.exists(page_path):
+                with open(page_path, "wb") as handle:
+                    handle.write(zlib.compress(page, 6))
+
+            self.pages[key] = None
+        else:
+            self.pages[key] = bytes(page)
+
+        return key
+
+    def get(self, key):
+        if key is None:
+            return PageStore.ZERO_PAGE
+
+        # Keys come from snapshot files, never let one name a path outside the store
+        if not isinstance(key, str) or not PageStore.KEY.fullmatch(key):
+            raise ValueError(f"Invalid page key: {key!r}")
+
+        page = self.pages.get(key)
+        if page is None:
+            if not self.path:
+                raise ValueError(f"Missing page: {key}")
+
+            try:
+                with open(os.path.join(self.path, key), "rb") as handle:
+                    page = zlib.decompress(handle.read())
+            except (OSError, zlib.error):
+                raise ValueError(f"Missing or corrupt page: {key}")
+
+            if hashlib.blake2b(page, digest_size=16).hexdigest() != key:
+                raise ValueError(f"Corrupt page: {key}")
+
+        return page
+
+    def save(self, buffer):
+        return [ self.put(buffer[offset:offset + PageStore.PAGE_SIZE]) for offset in range(0, len(buffer), PageStore.PAGE_SIZE) ]
+
+    def load(self, keys, buffer):
+        for index, key in enumerate(keys):
+            offset = index * PageStore.PAGE_SIZE
+            length = min(PageStore.PAGE_SIZE, len(buffer) - offset)
+            buffer[offset:offset + length] = self.get(key)[:length]
+
+class Stats:
+    def __init__(self, machine):
+        self.machine = machine
+        self.mmu = machine.mmu
+        self.io_bus = machine.io_bus
+        self.reads = collections.Counter()
+        self.writes = collections.Counter()
+        self.inputs = collections.Counter()
+        self.outputs = collections.Counter()
+        self.times = collections.Counter()
+        self.start = time.monotonic()
+        self.last = None
+
+        # Wrap the hot paths only when stats are enabled, so normal runs pay nothing
+        cpu = machine.cpu
+        self.mmu_read = self.mmu.read
+        self.mmu_write = self.mmu.write_flat if self.mmu.flat else self.mmu.write
+        cpu.set_read_callback(self.read)
+        cpu.set_write_callback(self.write)
+        cpu.set_input_callback(self.input)
+        cpu.set_output_callback(self.output)
+        machine.ctc.process_ticks = self.timed("ctc", machine.ctc.process_ticks)
+        machine.scheduler.run = self.timed("run", machine.scheduler.run)
+
+    def timed(self, name, func):
+        def wrapper(*args):
+            start = time.perf_counter()
+            result = func(*args)
+            self.times[name] += time.perf_counter() - start
+            return result
+
+        return wrapper
+
+    def read(self, addr):
+        start = time.perf_counter()
+        data = self.mmu_read(addr)
+        self.reads[self.mmu.page_names[addr >> 8]] += 1
+        self.times["mmu"] += time.perf_counter() - start
+        return data
+
+    def write(self, addr, data):
+        start = time.perf_counter()
+        self.mmu_write(addr, data)
+        self.writes[self.mmu.page_names[addr >> 8]] += 1
+        self.times["mmu"] += time.perf_counter() - start
+
+    def input(self, port):
+        start = time.perf_counter()
+        data = self.io_bus.input(port)
+        self.inputs[port] += 1
+        self.times[self.io_bus.names[port]] += time.perf_counter() - start
+        return data
+
+    def output(self, port, data):
+        start = time.perf_counter()
+        self.io_bus.output(port, data)
+        self.outputs[port] += 1
+        self.times[self.io_bus.names[port]] += time.perf_counter() - start
+
+    @classmethod
+    def get_core(cls, times):
+        # The core is what remains of run time after the callbacks made during it
+        times["core"] = times.pop("run", 0) - sum(seconds for name, seconds in times.items() if name != "render")
+        return times
+
+    def get_times(self):
+        times = Stats.get_core(dict(self.times))
+        return { name: round(seconds, 4) for name, seconds in sorted(times.items()) }
+
+    def get_report(self):
+        machine = self.machine
+
+        return {
+            "seconds": round(time.monotonic() - self.start, 4), "cycles": machine.scheduler.cycles,
+            "idle_cycles": machine.scheduler.idle_cycles, "reads": dict(self.reads), "writes": dict(self.writes),
+            "inputs": { f"{port:#06x}": count for port, count in sorted(self.inputs.items()) },
+            "outputs": { f"{port:#06x}": count for port, count in sorted(self.outputs.items()) },
+            "interrupts": machine.ctc.interrupts, "sectors_read": machine.floppy.sectors_read,
+            "sectors_written": machine.floppy.sectors_written, "frames": machine.cga.frames if machine.cga else 0,
+            "times": self.get_times(),
+        }
+
+    def get_status(self):
+        # Rates since the previous status line
+        machine = self.machine
+        now = time.monotonic()
+        current = (now, machine.scheduler.cycles, sum(self.reads.values()), sum(self.writes.values()),
+                   sum(self.inputs.values()) + sum(self.outputs.values()), sum(machine.ctc.interrupts),
+                   sum(machine.floppy.sectors_read) + sum(machine.floppy.sectors_written), machine.cga.frames, dict(self.times))
+
+        last = self.last or (self.start, 0, 0, 0, 0, 0, 0, 0, {})
+        self.last = current
+        elapsed = max(now - last[0], 0.001)
+        rates = [ (value - previous) / elapsed for value, previous in zip(current[1:8], last[1:8]) ]
+        busy = Stats.get_core({ name: (current[8][name] - last[8].get(name, 0)) / elapsed for name in current[8] })
+
+        return (f"{rates[0] / 1000000:.2f}MHz rd:{rates[1]:.0f}/s wr:{rates[2]:.0f}/s io:{rates[3]:.0f}/s int:{rates[4]:.0f}/s "
+                f"sec:{rates[5]:.0f}/s fps:{rates[6]:.0f} " + " ".join(f"{name}:{share:.0%}" for name, share in sorted(busy.items())))
+
+def open_logs():
+    global debug_log
+
+    # Keep one buffered handle per destination for the whole session
+    if args.debug:
+        log_handles["debug"] = open("debug.txt", "w", buffering=LOG_BUFFER)
+
+    debug_log = "debug" in log_handles
+
+def close_logs():
+    for handle in log_handles.values():
+        handle.close()
+
+    log_handles.clear()
+
+def log(message, *fmt_args, dest="debug"):
+    handle = log_handles.get(dest)
+    if handle is None:
+        return
+
+    # Only format messages that are actually written
+    if fmt_args:
+        message = message % fmt_args
+
+    handle.write(f"{message}\n")
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("rom", type=str, help="ROM image path")
     parser.add_argument("nvram", type=str, help="NVRAM image path")
     parser.add_argument("--d0", type=str, help="Floppy A: image path")
     parser.add_argument("--d1", type=str, help="Floppy B: image path")
     parser.add_argument("--tpa", type=str, help="Program image path (Loaded at 0x0100)")
-    parser.add_argument("--trace", action="store_true", help="Enable trace logging")
+    parser.add_argument("--trace", action="store_true", help="Enable trace recording (dumped to trace.bin)")
+    parser.add_argument("--trace-size", type=int, default=1000000, help="Instructions kept in the trace ring buffer")
     parser.add_argument("--debug", action="store_true", help="Enable debug mode")
     parser.add_argument("--iotest", action="store_true", help="Enter IO testing mode")
-    return parser.parse_args()
+    parser.add_argument("--flat", action="store_true", help="Run CPU directly from a mapped 64K window")
+    parser.add_argument("--fps", type=int, default=30, help="Maximum screen refresh rate")
+    parser.add_argument("--clock", type=float, default=7.159, help="Guest CPU clock in MHz for real-time pacing")
+    parser.add_argument("--turbo", action="store_true", help="Run as fast as possible (toggle with F12)")
+    parser.add_argument("--no-idle-skip", action="store_true", help="Keep running guest loops that wait on the keyboard instead of skipping ahead")
+    parser.add_argument("--save-state", type=str, help="Save machine state to path on exit (disk images are not included)")
+    parser.add_argument("--load-state", type=str, help="Resume machine state from path")
+    parser.add_argument("--headless", type=str, help="Run without a terminal from a key script (- for stdin)")
+    parser.add_argument("--screen", type=str, help="Write the final headless screen to path instead of stdout")
+    parser.add_argument("--timeout", type=float, default=60, help="Guest seconds a headless wait may take")
+    parser.add_argument("--profile", type=str, help="Sample the guest PC, write a report to path and folded stacks to path.folded on exit")
+    parser.add_argument("--profile-interval", type=int, default=5000, help="Cycles between profile samples")
+    parser.add_argument("--symbols", type=str, action="append", help="z80asm label file for the profile, as PATH[,MODE[,BANK]]")
+    parser.add_argument("--key-int", type=int, choices=range(1, 4), help="Also trigger this CTC counter channel on each key press")
+    parser.add_argument("--stats", type=str, help="Count per subsystem activity, write it to path as JSON on exit (F11 shows live)")
+    parser.add_argument("--copy-on-write", action="store_true", help="Keep disk and NVRAM writes private to this run")
+    parser.add_argument("--page-store", type=str, help="Directory of memory pages shared between state snapshots")
+    args = parser.parse_args(argv)
+
+    if args.fps < 1:
+        parser.error("--fps must be at least 1")
+
+    # The scheduler counts whole cycles per second
+    if int(args.clock * 1000000) < 1:
+        parser.error("--clock must be positive")
+
+    if args.trace_size < 1:
+        parser.error("--trace-size must be at least 1")
+
+    return args
 
-def input_handler(addr):
-    for component in io_bus:
-        val = component.input(addr)
-        if val is not None:
-            return val
+def signal_handler(sig, frame):
+    # Exiting from inside a CPU callback would leave a half executed instruction in the saved state
+    if (machine is not None) and machine.scheduler.running:
+        machine.scheduler.exit_pending = True
+        machine.scheduler.reschedule()
+    else:
+        sys.exit(0)
 
-    return 0x00
+def dump_handler(sig, frame):
+    if (machine is not None) and (machine.tracer is not None):
+        machine.tracer.dump(TRACE_PATH)
+
+def format_regs(mode, bank, pc, sp, a, bc, de, hl, ix, iy):
+    return "\t".join([f"PC:{mode}:{bank}:{hex(pc)[2:]}", f"SP: {hex(sp)}", f"A:{hex(a)}", f"BC:{hex(bc)}", f"DE:{hex(de)}", f"HL:{hex(hl)}", f"IX:{hex(ix)}", f"IY:{hex(iy)}"])
+
+class Machine:
+    def __init__(self, args):
+        self.args = args
+        self.cga = None
+        self.restored_state = None
+
+        # Create hardware
+        self.cpu = z80.Z80Machine()
+        self.mmu = MMU(self.cpu, args.flat, args.debug)
+        self.ctc = CTC(self.cpu, self.mmu, int(args.clock * 1000000))
+        self.scheduler = Scheduler(self.cpu, self.ctc, int(args.clock * 1000000), args.turbo)
+        self.tracer = Tracer(self.cpu, self.mmu, args.trace_size) if args.trace else None
+        self.profiler = Profiler(self.cpu, self.mmu, args.profile_interval) if args.profile else None
+        self.page_store = PageStore(args.page_store) if args.page_store else None
+        self.keyboard = Keyboard(self.ctc, args.key_int, not args.no_idle_skip)
+        self.floppy = Floppy()
+        self.io_bus = IOBus()
+        self.io_bus.attach(self.mmu)
+        self.io_bus.attach(self.ctc)
+        self.io_bus.attach(self.keyboard)
+        self.io_bus.attach(self.floppy)
+
+        # Configure hardware
+        self.cpu.set_input_callback(self.io_bus.input)
+        self.cpu.set_output_callback(self.io_bus.output)
+
+        self.mmu.load_rom(args.rom)
+        # A resumed state brings its own NVRAM, keep it from overwriting the image
+        self.mmu.load_nvram(args.nvram, args.copy_on_write or bool(args.load_state))
+
+        if args.tpa:
+            self.mmu.load_tpa(args.tpa)
+
+        if args.d0:
+            self.floppy.paths[0] = args.d0
+            self.floppy.load_image(0, args.copy_on_write)
+
+        if args.d1:
+            self.floppy.paths[1] = args.d1
+            self.floppy.load_image(1, args.copy_on_write)
+
+        if args.load_state:
+            self.restored_state = self.load_state(args.load_state, self.page_store)
+
+        self.stats = Stats(self) if args.stats else None
+
+        # Tracing records every instruction, profiling keeps slices within one sampling interval
+        self.slice_limit = Scheduler.MAX_SLICE
+        if self.profiler is not None:
+            self.slice_limit = args.profile_interval
+        if self.tracer is not None:
+            self.slice_limit = 1
+
+    def save_state(self, path, store=None):
+        # Without a shared store the referenced pages are embedded in the snapshot
+        shared = store is not None
+        if not shared:
+            store = PageStore()
+
+        state = {
+            "cpu": store.save(self.cpu.get_state_view()), "cycles": self.scheduler.cycles,
+            "mmu": self.mmu.get_state(store), "ctc": self.ctc.get_state(), "keyboard": self.keyboard.get_state(),
+            "floppy": self.floppy.get_state(), "cga": self.cga.get_state() if self.cga is not None else None,
+            "pages": None if shared else [ [ key, len(page) ] for key, page in store.pages.items() ],
+        }
+
+        # Header, JSON document, then the raw embedded pages in document order
+        document = json.dumps(state).encode("utf-8")
+        pages = b"" if shared else b"".join(store.pages.values())
+
+        with open(path, "wb") as handle:
+            handle.write(STATE_HEADER.pack(STATE_MAGIC, len(document), 0 if shared else len(store.pages)))
+            handle.write(zlib.compress(document + pages, 6))
+
+    def load_state(self, path, store=None):
+        with open(path, "rb") as handle:
+            data = handle.read()
 
-def output_handler(addr, data):
-    handled = False
+        if not data.startswith(STATE_MAGIC):
+            raise ValueError(f"Not a ZISA-X state: {path}")
 
-    for component in io_bus:
-        handled = handled or component.output(addr, data)
+        _, document_size, page_count = STATE_HEADER.unpack_from(data)
 
-    if not handled:
-        log(f"Unhandled Output: {hex(addr)}:{hex(data)}")
+        try:
+            body = zlib.decompress(data[STATE_HEADER.size:])
+        except zlib.error:
+            raise ValueError(f"Corrupt state: {path}")
 
-def signal_handler(sig, frame):
-    sys.exit(0)
+        state = json.loads(body[:document_size].decode("utf-8"))
 
-def get_regs():
-    return "\t".join([f"PC:{mmu.r_mode}:{mmu.r_pri_bank}:{hex(cpu.pc)[2:]}", f"SP: {hex(cpu.sp)}", f"A:{hex(cpu.a)}", f"BC:{hex(cpu.bc)}", f"DE:{hex(cpu.de)}", f"HL:{hex(cpu.hl)}", f"IX:{hex(cpu.ix)}", f"IY:{hex(cpu.iy)}"])
+        if state["pages"] is not None:
+            if len(state["pages"]) != page_count:
+                raise ValueError(f"Corrupt state: {path}")
 
-def get_stack_usage():
-    sections = { "PROG/MODULE": (0x0100, 0x8000), "STARTUP": (0x8000, 0xC000), "CCP": (0xC000, 0xC8F9), "BDOS": (0xC8F9, 0xDA00), "INT": (0xDA00, 0xF000)}
-    addrs = list(sorted(mmu.stack_used))
-    strs = []
-    start = 0
-    stop = 0
+            store = PageStore()
+            offset = document_size
 
-    for addr in addrs:
-        if (addr > stop + 2) or (addrs[-1] == addr):
-            secrange = "Unknown"
+            # Embedded pages are checked against their content keys
+            for key, length in state["pages"]:
+                page = body[offset:offset + length]
+                if (len(page) != length) or (hashlib.blake2b(page, digest_size=16).hexdigest() != key):
+                    raise ValueError(f"Corrupt state: {path}")
 
-            for section in sections:
-                if start > sections[section][0] and stop <= sections[section][1]:
-                    secrange = f"{section}"
+                store.pages[key] = page
+                offset += length
 
-            strs.append(f"{hex(start)}:{hex(stop)} ({stop - start}) - ({secrange})")
-            start = addr
+        elif store is None:
+            raise ValueError(f"State needs its page store: {path}")
 
-        stop = addr
+        # CPU first, flat mode then reloads its window from the restored MMU
+        store.load(state["cpu"], self.cpu.get_state_view())
+        self.scheduler.cycles = state["cycles"]
+        self.scheduler.resync()
+        self.mmu.set_state(state["mmu"], store)
+        self.ctc.set_state(state["ctc"])
+        self.keyboard.set_state(state["keyboard"])
+        self.floppy.set_state(state["floppy"])
 
-    strs.append("")
+        return state
 
-    for section in sections:
-        start = 0x10000
-        stop = 0
+    def attach_screen(self, screen):
+        self.cga = screen
+        self.io_bus.attach(screen)
 
-        for addr in addrs:
-            if addr > sections[section][0] and addr <= sections[section][1]:
-                if addr < start: start = addr
-                if addr > stop: stop = addr
+        if self.stats is not None:
+            screen.render = self.stats.timed("render", screen.render)
 
-        strs.append(f"{section}  {hex(start)}:{hex(stop)} ({stop - start})")
+        if self.restored_state and self.restored_state["cga"]:
+            screen.set_state(self.restored_state["cga"])
 
-    return "\n".join(strs)
+    def get_regs(self):
+        cpu = self.cpu
+        return format_regs(self.mmu.r_mode, self.mmu.r_pri_bank, cpu.pc, cpu.sp, cpu.a, cpu.bc, cpu.de, cpu.hl, cpu.ix, cpu.iy)
 
-def main_loop(stdscr):
-    cga = CGA(stdscr, mmu.isa)
-    io_bus.append(cga)
-    stdscr.nodelay(True)
-    tick = 0
+    def get_stack_usage(self):
+        sections = SECTIONS
+        strs = []
 
-    # Clock
-    while True:
-        cpu.ticks_to_stop = 1 if args.trace else 1000
-        tick += 1
+        for (mode, bank), stack_map in sorted(self.mmu.stack_maps.items()):
+            addrs = [ addr for addr, used in enumerate(stack_map) if used ]
+            if not addrs:
+                continue
 
-        if args.trace:
-            log(get_regs(), "trace")
+            strs.append(f"BANK {mode}:{bank}")
+            start = addrs[0]
+            stop = addrs[0]
 
-        cpu.run()
-        ctc.process_tick()
+            for addr in addrs[1:] + [ None ]:
+                if (addr is None) or (addr > stop + 2):
+                    secrange = "Unknown"
 
-        key = stdscr.getch()
-        if key > 0:
-            if key == 127: key = 8
-            elif key == 330: key = 127
-            elif key == 10: key = 13
-            elif key == 360: key = 3
-            keyboard.put_key(key)
+                    for section in sections:
+                        if start > sections[section][0] and stop <= sections[section][1]:
+                            secrange = f"{section}"
 
-        # Refresh screen periodically
-        if (tick % 50  == 0):
-            cga.render()
+                    strs.append(f"{hex(start)}:{hex(stop)} ({stop - start}) - ({secrange})")
+                    start = addr
 
-        if (args.debug and (cpu._Z80State__halted[0] > 0)):
-            cga.render()
-            print("**HALT**")
-            input("")
+                stop = addr
 
-def main():
-    global io_bus, cpu, mmu, ctc, keyboard, floppy
+            strs.append("")
 
-    if args.debug:
-        if os.path.exists("debug.txt"):
-            os.remove("debug.txt")
+            # Lowest and highest stack pointer (high-water depth) per section
+            for section in sections:
+                used = [ addr for addr in addrs if sections[section][0] < addr <= sections[section][1] ]
+                if used:
+                    strs.append(f"{section}  {hex(used[0])}:{hex(used[-1])} ({used[-1] - used[0]})")
 
-    if args.trace:
-        if os.path.exists("trace.txt"):
-            os.remove("trace.txt")
+            strs.append("")
 
-    signal.signal(signal.SIGINT, signal_handler)
+        return "\n".join(strs)
+
+    def main_loop(self, stdscr):
+        cpu, mmu, scheduler, keyboard, tracer, profiler = self.cpu, self.mmu, self.scheduler, self.keyboard, self.tracer, self.profiler
+
+        self.attach_screen(CGA(stdscr, mmu.isa))
+        cga = self.cga
+
+        stdscr.nodelay(True)
+        reader = InputReader(sys.stdin.fileno())
+        scheduler.wake = reader.wake
+        frame_delay = 1 / self.args.fps
+        frame_time = 0
+        status_time = 0
+        show_status = False
+
+        # Clock
+        while True:
+            if tracer is not None:
+                tracer.record()
+
+            scheduler.run(self.slice_limit)
+            mmu.sync_nvram()
+
+            if profiler is not None:
+                profiler.sample(scheduler.cycles)
+
+            # Only touch curses when the reader has seen input, then take everything pending
+            if reader.ready:
+                for key in iter(stdscr.getch, -1):
+                    if key == curses.KEY_F12:
+                        scheduler.set_turbo(not scheduler.turbo)
+
+                    elif (key == curses.KEY_F11) and (self.stats is not None):
+                        show_status = not show_status
+                        status_time = 0
+                        cga.shadow_valid = False
+                        cga.dirty = True
+
+                    elif key > 0:
+                        if key == 127: key = 8
+                        elif key == 330: key = 127
+                        elif key == 10: key = 13
+                        elif key == 360: key = 3
+                        keyboard.put_key(key)
+
+                reader.done()
+
+            # Refresh screen when video memory or the cursor changed, limited to the frame rate
+            if (mmu.video_dirty or cga.dirty) and (time.monotonic() - frame_time >= frame_delay):
+                cga.render(mmu.video_dirty)
+                mmu.video_dirty.clear()
+                frame_time = time.monotonic()
+
+            # Stats line below the text screen (over the last row on short terminals), once a second
+            if show_status and (time.monotonic() - status_time >= 1):
+                rows, cols = stdscr.getmaxyx()
+                stdscr.addnstr(min(rows - 1, 25), 0, self.stats.get_status().ljust(cols - 1), cols - 1, curses.A_REVERSE)
+                cga.set_cursor()
+                stdscr.refresh()
+                status_time = time.monotonic()
+
+            # Dump the trace when the machine halts
+            if tracer is not None:
+                halted = cpu._Z80State__halted[0] > 0
+                if halted and not tracer.halted:
+                    tracer.dump(TRACE_PATH)
+                tracer.halted = halted
+
+            if (self.args.debug and (cpu._Z80State__halted[0] > 0)):
+                cga.render()
+                print("**HALT**")
+                input("")
+
+    def run_headless(self, cycles, done=None):
+        # Run for a number of cycles, or until done() holds after a screen update
+        mmu, scheduler, tracer, profiler = self.mmu, self.scheduler, self.tracer, self.profiler
+        end_cycles = scheduler.cycles + cycles
+
+        # The screen may already show what we are waiting for, unless typed keys are still pending
+        if (done is not None) and not self.keyboard.queue and done():
+            return True
+
+        while scheduler.cycles < end_cycles:
+            if tracer is not None:
+                tracer.record()
+
+            scheduler.run(self.slice_limit)
+            mmu.sync_nvram()
+
+            if profiler is not None:
+                profiler.sample(scheduler.cycles)
+
+            # Each screen update seen between slices counts as a frame
+            if mmu.video_dirty or self.cga.dirty:
+                mmu.video_dirty.clear()
+                self.cga.dirty = False
+                self.cga.frames += 1
+
+                if (done is not None) and done():
+                    return True
+
+        return done is None
+
+    # Script lines: "t TEXT" types, "w TEXT" waits for TEXT before the cursor, "r SECONDS" runs, "#" comments
+    def headless_loop(self):
+        self.attach_screen(TextScreen(self.mmu.isa))
+        self.scheduler.set_turbo(True)
+        timeout = int(self.args.timeout * self.scheduler.clock)
+        handle = sys.stdin if self.args.headless == "-" else open(self.args.headless, "r")
 
-    # Create hardware
-    cpu = z80.Z80Machine()
-    mmu = MMU(cpu)
-    ctc = CTC(cpu, mmu)
-    keyboard = Keyboard()
-    floppy = Floppy()
-    io_bus = []
-    io_bus.append(mmu)
-    io_bus.append(ctc)
-    io_bus.append(keyboard)
-    io_bus.append(floppy)
+        for line in handle:
+            line = line.rstrip("\n")
+            if not line or line[0] == "#": continue
 
-    # Configure hardware
-    cpu.set_input_callback(input_handler)
-    cpu.set_output_callback(output_handler)
+            text = line[2:].encode("latin1").decode("unicode_escape")
 
-    mmu.load_rom(args.rom)
-    mmu.load_nvram(args.nvram)
+            if line[0] == "t":
+                keys = [ 13 if char == "\n" else ord(char) for char in text ]
 
-    if args.tpa:
-        mmu.load_tpa(args.tpa)
+                for key in keys:
+                    if chr(key) not in Keyboard.CODE_TRANS:
+                        print(f"Unsupported key in script: {chr(key)!r}", file=sys.stderr)
+                        return 1
 
-    if args.d0:
-        floppy.paths[0] = args.d0
-        floppy.load_image(0)
+                for key in keys:
+                    self.keyboard.put_key(key)
 
-    if args.d1:
-        floppy.paths[1] = args.d1
-        floppy.load_image(1)
+            elif line[0] == "w":
+                if not self.run_headless(timeout, lambda: self.cga.get_prompt().endswith(text)):
+                    print(f"Timed out waiting for: {text}", file=sys.stderr)
+                    return 1
+
+            elif line[0] == "r":
+                self.run_headless(int(float(text) * self.scheduler.clock))
+
+        return 0
 
     # Format: "i"/"o",PORT (4 hex),DATA (2 hex)
-    if args.iotest:
+    def iotest_loop(self):
         while True:
             cmd = input()
             cmd = cmd.replace(" ", "")
@@ -1207,38 +2440,99 @@ def main():
             addr = int(cmd[1:5], 16)
 
             if cmd[0] == "i":
-                val = input_handler(addr)
+                val = self.io_bus.input(addr)
                 print(hex(val), chr(val))
 
             if cmd[0] == "o":
                 data = int(cmd[5: 7], 16)
-                output_handler(addr, data)
+                self.io_bus.output(addr, data)
+
+    def close(self):
+        args = self.args
+
+        if args.save_state:
+            self.save_state(args.save_state, self.page_store)
+
+        # Flush NVRAM
+        self.mmu.sync_nvram(True)
+
+        # Update disks
+        if args.d0:
+            self.floppy.save_image(0)
+
+        if args.d1:
+            self.floppy.save_image(1)
 
+        if self.tracer is not None:
+            self.tracer.dump(TRACE_PATH)
+
+        if self.profiler is not None:
+            symbols = [ Profiler.load_symbols(spec) for spec in args.symbols or [] ]
+            self.profiler.write_report(args.profile, symbols)
+
+        if self.stats is not None:
+            with open(args.stats, "w") as handle:
+                json.dump(self.stats.get_report(), handle, indent=2)
+
+        # Final screen of a headless run
+        if args.headless and (self.cga is not None):
+            if args.screen:
+                with open(args.screen, "w") as handle:
+                    handle.write(self.cga.get_text())
+            else:
+                sys.stdout.write(self.cga.get_text())
+
+def main():
+    global machine
+
+    open_logs()
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGUSR1, dump_handler)
+
+    if args.flat and not hasattr(z80.Z80Machine, "WRITE_MARK"):
+        print("Flat memory mode requires a Z80 core with address marks")
+        sys.exit(1)
+
+    # Bad snapshots, page stores and disk geometries are reported without a traceback
+    try:
+        machine = Machine(args)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
+
+    if args.iotest:
+        machine.iotest_loop()
         sys.exit(0)
 
-    curses.wrapper(main_loop)
+    if args.headless:
+        sys.exit(machine.headless_loop())
+
+    curses.wrapper(machine.main_loop)
 
 def end():
-    if not args:
+    if machine is None:
         return
 
-    # Update disks
-    if args.d0:
-        floppy.save_image(0)
-
-    if args.d1:
-        floppy.save_image(1)
+    machine.close()
+    close_logs()
 
     if not args.debug:
         return
 
     # Update memory dump
+    if machine.mmu.flat:
+        machine.mmu.sync_window()
+
     with open("memdump.bin", "wb") as handle:
-        handle.write(mmu.ram)
+        handle.write(machine.mmu.ram)
 
     # Print final report
-    print(get_regs())
-    print(get_stack_usage())
+    print(machine.get_regs())
+    print(machine.get_stack_usage())
+
+    for port, count in machine.io_bus.unhandled_outputs.most_common():
+        print(f"Unhandled Output: {hex(port)} ({count})")
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,197 @@
+#! /usr/bin/env python3
+
+import argparse
+import json
+import os
+import sys
+import time
+import zisax
+
+IMAGES = os.path.join(os.path.dirname(os.path.abspath(zisax.__file__)), "images")
+
+# Workloads are hand assembled, timings are the documented Z80 T-states per loop iteration
+
+# 0100: ADD A,C / XOR D / INC HL / DEC E / RLCA / JP 0100
+ALU_PROGRAM = bytes([ 0x81, 0xAA, 0x23, 0x1D, 0x07, 0xC3, 0x00, 0x01 ])
+ALU_TICKS = 32
+ALU_INSTRUCTIONS = 6
+
+# Ports are decoded on all 16 address bits, so I/O goes through OUT (C),A with B = 0
+
+# 8000: LD HL,1000 / LD DE,C000 / LD BC,2000 / LDIR / LD A,(8100) / INC A / AND 1F / LD (8100),A / LD BC,0002 / OUT (C),A / JP 8000
+COPY_PROGRAM = bytes([ 0x21, 0x00, 0x10, 0x11, 0x00, 0xC0, 0x01, 0x00, 0x20, 0xED, 0xB0, 0x3A, 0x00, 0x81, 0x3C,
+                       0xE6, 0x1F, 0x32, 0x00, 0x81, 0x01, 0x02, 0x00, 0xED, 0x79, 0xC3, 0x00, 0x80 ])
+COPY_BYTES = 0x2000
+COPY_TICKS = 10 + 10 + 10 + (21 * (COPY_BYTES - 1) + 16) + 13 + 4 + 7 + 13 + 10 + 12 + 10
+COPY_INSTRUCTIONS = 10 + COPY_BYTES
+
+# 0100: LD A,02 / LD I,A / IM 2 / LD SP,8000 / LD BC,0010 / vector 00, channel 0 timer with interrupt, constant 1 / LD DE,0 / EI / JR $
+CTC_PROGRAM = bytes([ 0x3E, 0x02, 0xED, 0x47, 0xED, 0x5E, 0x31, 0x00, 0x80, 0x01, 0x10, 0x00, 0x3E, 0x00, 0xED, 0x79,
+                      0x3E, 0x85, 0xED, 0x79, 0x3E, 0x01, 0xED, 0x79, 0x11, 0x00, 0x00, 0xFB, 0x18, 0xFE ])
+
+# 0120: INC DE / EI / RETI, vectored from 0200
+CTC_HANDLER = bytes([ 0x13, 0xFB, 0xED, 0x4D ])
+
+# 0100: LD HL,F0A0 / LD DE,F000 / LD BC,0F00 / LDIR / INC A / LD (FF00),A / JP 0100
+SCROLL_PROGRAM = bytes([ 0x21, 0xA0, 0xF0, 0x11, 0x00, 0xF0, 0x01, 0x00, 0x0F, 0xED, 0xB0, 0x3C, 0x32, 0x00, 0xFF,
+                         0xC3, 0x00, 0x01 ])
+SCROLL_BYTES = 0x0F00
+SCROLL_TICKS = 10 + 10 + 10 + (21 * (SCROLL_BYTES - 1) + 16) + 4 + 13 + 10
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cycles", type=int, default=20000000, help="Guest cycles per CPU workload")
+    parser.add_argument("--flat", action="store_true", help="Run CPU directly from a mapped 64K window")
+    parser.add_argument("--output", type=str, help="JSON results path (default stdout)")
+    return parser.parse_args()
+
+def create_machine(flat, disk=None):
+    argv = [ os.path.join(IMAGES, "rom.bin"), os.path.join(IMAGES, "nvram.bin"), "--turbo", "--copy-on-write" ]
+    if disk: argv += [ "--d0", disk ]
+    if flat: argv.append("--flat")
+
+    return zisax.Machine(zisax.parse_args(argv))
+
+def setup_memory(machine, mapped, isa_bank=0):
+    # Switch the MMU to RAM (bank 0) before loading code
+    for port, data in enumerate([ mapped, 0x01, 0x00, isa_bank ]):
+        machine.io_bus.output(zisax.MMU.PORT_BASE + port, data)
+
+def load(machine, addr, data):
+    for offset, value in enumerate(data):
+        machine.mmu.write(addr + offset, value)
+
+    if machine.mmu.flat:
+        machine.mmu.load_window()
+
+def run_cpu(machine, cycles, start):
+    machine.cpu.pc = start
+    begin = time.monotonic()
+
+    while machine.scheduler.cycles < cycles:
+        machine.scheduler.run()
+
+    return time.monotonic() - begin
+
+def get_rates(seconds, cycles, **counts):
+    result = { "seconds": round(seconds, 4), "cycles": cycles, "cycles_per_sec": round(cycles / seconds) }
+
+    for name, count in counts.items():
+        result[name] = count
+        result[f"{name}_per_sec"] = round(count / seconds)
+
+    return result
+
+def bench_alu(args):
+    machine = create_machine(args.flat)
+    setup_memory(machine, 0x03)
+    load(machine, 0x0100, ALU_PROGRAM)
+
+    seconds = run_cpu(machine, args.cycles, 0x0100)
+    cycles = machine.scheduler.cycles
+
+    return get_rates(seconds, cycles, instructions=cycles * ALU_INSTRUCTIONS // ALU_TICKS)
+
+def bench_copy(args):
+    # Banked lower 32K is copied into fixed upper RAM, switching banks after every block
+    machine = create_machine(args.flat)
+    setup_memory(machine, 0x02)
+    load(machine, 0x8000, COPY_PROGRAM)
+
+    seconds = run_cpu(machine, args.cycles, 0x8000)
+    cycles = machine.scheduler.cycles
+    blocks = cycles / COPY_TICKS
+
+    return get_rates(seconds, cycles, instructions=int(blocks * COPY_INSTRUCTIONS), bytes=int(blocks * COPY_BYTES))
+
+def bench_ctc(args):
+    machine = create_machine(args.flat)
+    setup_memory(machine, 0x03)
+    load(machine, 0x0100, CTC_PROGRAM)
+    load(machine, 0x0120, CTC_HANDLER)
+    load(machine, 0x0200, bytes([ 0x20, 0x01 ]))
+
+    seconds = run_cpu(machine, args.cycles, 0x0100)
+
+    return get_rates(seconds, machine.scheduler.cycles, interrupts=machine.cpu.de)
+
+def bench_scroll(args):
+    # Scroll the text frame buffer through the ISA window, reading the screen back as each frame changes
+    machine = create_machine(args.flat)
+    machine.attach_screen(zisax.TextScreen(machine.mmu.isa))
+    setup_memory(machine, 0x05, zisax.CGA.FB_START >> 12)
+    load(machine, 0x0100, SCROLL_PROGRAM)
+    machine.cpu.pc = 0x0100
+
+    cpu_seconds = 0
+    render_seconds = 0
+    frames = 0
+
+    while machine.scheduler.cycles < args.cycles:
+        begin = time.monotonic()
+        machine.scheduler.run()
+        cpu_seconds += time.monotonic() - begin
+
+        if machine.mmu.video_dirty:
+            begin = time.monotonic()
+            machine.cga.get_text()
+            machine.mmu.video_dirty.clear()
+            render_seconds += time.monotonic() - begin
+            frames += 1
+
+    cycles = machine.scheduler.cycles
+    result = get_rates(cpu_seconds + render_seconds, cycles, bytes=int(cycles / SCROLL_TICKS * SCROLL_BYTES), frames=frames)
+    result["cpu_seconds"] = round(cpu_seconds, 4)
+    result["render_seconds"] = round(render_seconds, 4)
+
+    return result
+
+def bench_floppy(args):
+    # Read every sector of a full disk through the controller's FIFO, the way the BIOS driver does
+    machine = create_machine(args.flat, os.path.join(IMAGES, "cpm22.img"))
+    floppy = zisax.Floppy
+    geometry = machine.floppy.geometries[0]
+    data = floppy.PORT_BASE + floppy.REG_FIFO
+    dtl = geometry.sector_size if geometry.size_code == 0 else 0xFF
+    count = 0
+
+    machine.io_bus.output(floppy.PORT_BASE + floppy.REG_DSR, 0x80)
+    machine.io_bus.output(floppy.PORT_BASE + floppy.REG_DOR, 0x10)
+    begin = time.monotonic()
+
+    for track in range(geometry.tracks):
+        for head in range(geometry.heads):
+            for byte in [ 0x06, head << 2, track, head, 1, geometry.size_code, geometry.sectors, 0, dtl ]:
+                machine.io_bus.output(data, byte)
+
+            for _ in range(geometry.track_size):
+                machine.io_bus.input(data)
+
+            # Result phase
+            for _ in range(7):
+                machine.io_bus.input(data)
+
+            count += geometry.track_size
+
+    seconds = time.monotonic() - begin
+
+    return { "seconds": round(seconds, 4), "bytes": count, "bytes_per_sec": round(count / seconds) }
+
+WORKLOADS = { "alu": bench_alu, "copy": bench_copy, "ctc": bench_ctc, "scroll": bench_scroll, "floppy": bench_floppy }
+
+def main():
+    args = parse_args()
+    results = { "flat": args.flat, "cycles": args.cycles, "workloads": {} }
+
+    for name, workload in WORKLOADS.items():
+        results["workloads"][name] = workload(args)
+
+    handle = open(args.output, "w") if args.output else sys.stdout
+    json.dump(results, handle, indent=2)
+    handle.write("\n")
+
+    if handle is not sys.stdout:
+        handle.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#! /usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import zisax
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rom", type=str, help="ROM image path")
+    parser.add_argument("nvram", type=str, help="Base NVRAM image path")
+    parser.add_argument("scripts", type=str, nargs="+", help="Headless key scripts, one machine each")
+    parser.add_argument("--d0", type=str, help="Base floppy A: image path")
+    parser.add_argument("--d1", type=str, help="Base floppy B: image path")
+    parser.add_argument("--flat", action="store_true", help="Run CPUs directly from a mapped 64K window")
+    parser.add_argument("--timeout", type=float, default=60, help="Guest seconds a headless wait may take")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Machines run in parallel")
+    parser.add_argument("--out", type=str, default="fleet", help="Directory for final screens")
+    parser.add_argument("--report", type=str, help="Write results as JSON to path")
+    return parser.parse_args()
+
+def run_job(name, argv):
+    # Runs in a worker process, disks and NVRAM are copy-on-write so jobs never see each other's writes
+    args = zisax.parse_args(argv)
+    start = time.monotonic()
+    machine = zisax.Machine(args)
+
+    # Only the script's own result counts as success, an exit from inside the machine (ROM write, signal) is a failure
+    try:
+        status = machine.headless_loop()
+    except SystemExit as error:
+        status = error.code or 1
+    finally:
+        machine.close()
+
+    return { "name": name, "status": status, "seconds": round(time.monotonic() - start, 3),
+             "cycles": machine.scheduler.cycles, "screen": args.screen }
+
+def main():
+    args = parse_args()
+    os.makedirs(args.out, exist_ok=True)
+
+    # Each script becomes one headless machine sharing the base images
+    jobs = {}
+    for script in args.scripts:
+        name = os.path.splitext(os.path.basename(script))[0]
+        argv = [ args.rom, args.nvram, "--headless", script, "--screen", os.path.join(args.out, f"{name}.txt"),
+                 "--timeout", str(args.timeout), "--copy-on-write" ]
+
+        if args.d0: argv += [ "--d0", args.d0 ]
+        if args.d1: argv += [ "--d1", args.d1 ]
+        if args.flat: argv.append("--flat")
+
+        jobs[name] = argv
+
+    results = []
+    start = time.monotonic()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = { pool.submit(run_job, name, argv): name for name, argv in jobs.items() }
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                result = { "name": futures[future], "status": -1, "error": str(error) }
+
+            results.append(result)
+            print(f"{result['status']}\t{result.get('seconds', 0):.2f}s\t{result['name']}")
+
+    failed = sum(1 for result in results if result["status"] != 0)
+    print(f"{len(results) - failed}/{len(results)} passed in {time.monotonic() - start:.2f}s")
+
+    if args.report:
+        with open(args.report, "w") as handle:
+            json.dump(sorted(results, key=lambda result: result["name"]), handle, indent=2)
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
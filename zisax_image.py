@@ -0,0 +1,198 @@
+#! /usr/bin/env python3
+
+import argparse
+import math
+import os
+import sys
+import zisax
+
+# CP/M disk parameters, matching the BIOS DPB (see development/cpmtools.def)
+GEOMETRY = zisax.Floppy.GEOMETRIES["zisax"]
+RECORD_SIZE = 128
+RECORDS_TRACK = GEOMETRY.heads * GEOMETRY.track_size // RECORD_SIZE
+RESERVED_TRACKS = 1
+BLOCK_SIZE = 2048
+BLOCK_COUNT = 156
+DIR_ENTRIES = 64
+DIR_BLOCKS = 1
+ENTRY_SIZE = 32
+ENTRY_BLOCKS = 16
+ENTRY_RECORDS = ENTRY_BLOCKS * BLOCK_SIZE // RECORD_SIZE
+EXTENT_RECORDS = 128
+EMPTY = 0xE5
+EOF_BYTE = 0x1A
+
+# Boot sector: ZB|NUM_BLOCKS_COPY|DEST_ADDR|BOOT_ADDR|TYPE, blocks are 256 bytes
+BOOT_MAGIC = b"ZB"
+BOOT_BLOCK = 256
+
+def parse_int(text):
+    return int(text, 0)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert = commands.add_parser("convert", help="Reorder an image of any geometry between file (logical) and physical track order")
+    convert.add_argument("image", type=str, help="Source image path")
+    convert.add_argument("output", type=str, help="Converted image path")
+    convert.add_argument("--to", choices=[ "physical", "logical" ], default="physical", help="Target order")
+
+    create = commands.add_parser("create", help="Create a blank ZISA-X CP/M image, optionally bootable")
+    create.add_argument("image", type=str, help="New image path")
+    create.add_argument("--boot", type=str, help="Binary installed on the reserved track with a ZB boot sector")
+    create.add_argument("--dest", type=parse_int, default=0xC000, help="Boot copy destination address")
+    create.add_argument("--start", type=parse_int, default=0xC000, help="Boot jump address")
+    create.add_argument("--type", type=parse_int, default=1, help="Boot type (0: generic, 1: CP/M 2.2)")
+
+    put = commands.add_parser("put", help="Copy files into a CP/M image")
+    put.add_argument("image", type=str, help="Image path")
+    put.add_argument("files", type=str, nargs="+", help="Host files to copy")
+    put.add_argument("--user", type=int, default=0, help="CP/M user number")
+
+    dir_parser = commands.add_parser("dir", help="List the files on a CP/M image")
+    dir_parser.add_argument("image", type=str, help="Image path")
+
+    return parser.parse_args()
+
+def read_image(path, geometry=GEOMETRY):
+    with open(path, "rb") as handle:
+        data = bytearray(handle.read())
+
+    if len(data) > geometry.disk_size:
+        raise ValueError(f"Image larger than a {geometry.name} disk: {path}")
+
+    # Short images read back as unformatted space
+    data += bytes([ EMPTY ]) * (geometry.disk_size - len(data))
+    return data
+
+def write_image(path, data):
+    with open(path, "wb") as handle:
+        handle.write(data)
+
+def get_block_offset(block):
+    return (RESERVED_TRACKS * RECORDS_TRACK * RECORD_SIZE) + (block * BLOCK_SIZE)
+
+def create_image(boot=None, dest=0xC000, start=0xC000, boot_type=1):
+    data = bytearray([ EMPTY ]) * GEOMETRY.disk_size
+
+    if boot is not None:
+        # Boot code follows the boot sector on the reserved tracks
+        space = (RESERVED_TRACKS * RECORDS_TRACK - 1) * RECORD_SIZE
+        if len(boot) > space:
+            raise ValueError(f"Boot binary needs {len(boot)} bytes, reserved tracks hold {space}")
+
+        header = BOOT_MAGIC + bytes([ math.ceil(len(boot) / BOOT_BLOCK) ]) + dest.to_bytes(2, "little")
+        header += start.to_bytes(2, "little") + bytes([ boot_type ])
+        data[0:RECORD_SIZE] = header.ljust(RECORD_SIZE, b"\x00")
+        data[RECORD_SIZE:RECORD_SIZE + len(boot)] = boot
+
+    return data
+
+def get_entries(data):
+    offset = get_block_offset(0)
+    return [ memoryview(data)[offset + index * ENTRY_SIZE:offset + (index + 1) * ENTRY_SIZE] for index in range(DIR_ENTRIES) ]
+
+def get_cpm_name(path):
+    # Host name -> 11 byte padded, upper case 8.3 name
+    name, _, ext = os.path.basename(path).upper().partition(".")
+    if not name or (len(name) > 8) or (len(ext) > 3):
+        raise ValueError(f"Not a CP/M 8.3 file name: {path}")
+
+    return (name.ljust(8) + ext.ljust(3)).encode("ascii")
+
+def delete_file(data, user, name):
+    for entry in get_entries(data):
+        if (entry[0] == user) and (bytes(entry[1:12]) == name):
+            entry[0] = EMPTY
+
+def put_file(data, user, name, contents):
+    delete_file(data, user, name)
+    entries = get_entries(data)
+
+    # Blocks in use by the directory and existing files
+    used = set(range(DIR_BLOCKS))
+    for entry in entries:
+        if entry[0] != EMPTY:
+            used.update(block for block in entry[16:32] if block)
+
+    records = math.ceil(len(contents) / RECORD_SIZE)
+    blocks_needed = math.ceil(len(contents) / BLOCK_SIZE)
+    free_blocks = [ block for block in range(BLOCK_COUNT) if block not in used ]
+    free_entries = [ entry for entry in entries if entry[0] == EMPTY ]
+
+    if blocks_needed > len(free_blocks):
+        raise ValueError(f"Disk full writing {name.decode('ascii')}")
+
+    if max(1, math.ceil(blocks_needed / ENTRY_BLOCKS)) > len(free_entries):
+        raise ValueError(f"Directory full writing {name.decode('ascii')}")
+
+    # The last record is padded with the CP/M end of file marker
+    padded = contents + bytes([ EOF_BYTE ]) * (records * RECORD_SIZE - len(contents))
+    blocks = free_blocks[:blocks_needed]
+
+    for block_index, block in enumerate(blocks):
+        offset = get_block_offset(block)
+        chunk = padded[block_index * BLOCK_SIZE:(block_index + 1) * BLOCK_SIZE]
+        data[offset:offset + len(chunk)] = chunk
+
+    # Each directory entry maps 16 blocks, covering two 16K extents
+    for entry_index in range(max(1, math.ceil(blocks_needed / ENTRY_BLOCKS))):
+        entry = free_entries[entry_index]
+        entry_records = min(records - entry_index * ENTRY_RECORDS, ENTRY_RECORDS)
+        last_extent = max(0, entry_records - 1) // EXTENT_RECORDS
+        extent = entry_index * (ENTRY_RECORDS // EXTENT_RECORDS) + last_extent
+        entry_blocks = bytes(blocks[entry_index * ENTRY_BLOCKS:(entry_index + 1) * ENTRY_BLOCKS])
+
+        entry[0:16] = bytes([ user ]) + name + bytes([ extent & 0x1F, 0, extent >> 5, entry_records - last_extent * EXTENT_RECORDS ])
+        entry[16:32] = entry_blocks.ljust(ENTRY_BLOCKS, b"\x00")
+
+def list_files(data):
+    # (user, name) -> records
+    files = {}
+
+    for entry in get_entries(data):
+        if entry[0] > 15:
+            continue
+
+        # High bits of the name hold file attributes
+        key = (entry[0], bytes(char & 0x7F for char in entry[1:12]).decode("ascii"))
+        files[key] = files.get(key, 0) + (entry[12] % 2) * EXTENT_RECORDS + entry[15]
+
+    return files
+
+def main():
+    args = parse_args()
+
+    if args.command == "convert":
+        # Any geometry, detected from the image size or its sidecar
+        geometry = zisax.Floppy.get_geometry(args.image)
+        write_image(args.output, geometry.convert(read_image(args.image, geometry), args.to == "physical"))
+
+    elif args.command == "create":
+        boot = None
+        if args.boot:
+            with open(args.boot, "rb") as handle:
+                boot = handle.read()
+
+        write_image(args.image, create_image(boot, args.dest, args.start, args.type))
+
+    elif args.command == "put":
+        data = read_image(args.image)
+
+        for path in args.files:
+            with open(path, "rb") as handle:
+                put_file(data, args.user, get_cpm_name(path), handle.read())
+
+        write_image(args.image, data)
+
+    elif args.command == "dir":
+        for (user, name), records in sorted(list_files(read_image(args.image)).items()):
+            print(f"{user}: {name[:8].rstrip()}.{name[8:].rstrip()}\t{records * RECORD_SIZE}")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,25 @@
+#! /usr/bin/env python3
+
+import argparse
+import sys
+import zisax
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace", type=str, help="Binary trace path (trace.bin)")
+    parser.add_argument("--output", type=str, help="Text trace path (default stdout)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    handle = open(args.output, "w") if args.output else sys.stdout
+
+    # Render records in the emulator's tab separated register format
+    for record in zisax.Tracer.load(args.trace):
+        handle.write(f"{zisax.format_regs(*record)}\n")
+
+    if handle is not sys.stdout:
+        handle.close()
+
+if __name__ == "__main__":
+    main()